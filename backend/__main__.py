@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import asyncio
 import secrets
 import starlette.websockets
+import threading
 import uvicorn
 from datetime import datetime
 from fastapi import FastAPI, Request, WebSocket
@@ -11,11 +13,14 @@ from typing import Any
 
 from .endpoints import ws_handlers
 from .lib import database
+from .lib.backplane import WORKERS, BACKPLANE, BACKPLANE_SOCKET, BackplaneUnavailable, Broker, backplane
 from .lib.errors import AuthError, JsonError
+from .lib.presence import PresenceService
 from .lib.security import check_password
 from .lib.utils import require
-from .lib.presence import connected_users
-from .models.database_models import User, Session, Connection, get_pool
+from .lib.wire import WS_COMPRESSION, negotiate, negotiate_compression
+from .lib.watcher import file_index
+from .models.database_models import User, Session, Connection, deliver, get_pool
 from .models.request_models import AuthRequest, GMRequest
 from .endpoints.admin import router as admin_router
 from .endpoints.abilities import router as ability_router
@@ -32,6 +37,41 @@ from .endpoints.folders import router as folder_router
 app = FastAPI()
 
 
+async def announce_presence(user_id: str, online: bool):
+    await get_pool("users").broadcast({
+        "type": "connect" if online else "disconnect",
+        "id": user_id,
+    })
+
+
+presence = PresenceService(database.presence, announce_presence)
+
+
+@app.on_event("startup")
+async def start_backplane():
+    await backplane.start(deliver)
+
+
+@app.on_event("shutdown")
+async def stop_backplane():
+    await backplane.stop()
+
+
+@app.on_event("startup")
+async def start_presence():
+    await presence.start()
+
+
+@app.on_event("shutdown")
+async def stop_presence():
+    await presence.stop()
+
+
+@app.on_event("startup")
+async def start_file_index():
+    await file_index.start()
+
+
 @app.exception_handler(AuthError)
 async def auth_error_handler(request: Request, exc: AuthError):
     return JSONResponse(status_code=401, content={
@@ -40,6 +80,14 @@ async def auth_error_handler(request: Request, exc: AuthError):
     })
 
 
+@app.exception_handler(BackplaneUnavailable)
+async def backplane_error_handler(request: Request, exc: BackplaneUnavailable):
+    return JSONResponse(status_code=503, content={
+        "status": "error",
+        "reason": str(exc)
+    })
+
+
 @app.exception_handler(JsonError)
 async def json_error_handler(request: Request, exc: JsonError):
     return JSONResponse(status_code=400, content={
@@ -104,14 +152,18 @@ async def handle_ws_request(connection: Connection, request: dict[str, Any]):
         raise JsonError("invalid json request")
     message_type = request.get("type")
     if message_type == "heartbeat":
+        presence.heartbeat(connection.lease_id)
         return
 
     print("/api/live - Request -", request)
 
     if message_type == "subscribe":
         pool = get_pool(request)
-        pool.add(connection)
+        since = request.get("since")
+        if since is not None and not isinstance(since, int):
+            raise JsonError("invalid sequence number")
         connection.pools.add(pool)
+        await pool.subscribe(connection, since, request.get("epoch"))
     elif message_type == "unsubscribe":
         pool = get_pool(request)
         pool.discard(connection)
@@ -146,16 +198,14 @@ async def live_connection(websocket: WebSocket):
 
     print("/api/live - Handshake -", user.name)
     # Begin subscription loop
-    connection = Connection(user, websocket)
+    connection = Connection(
+        user,
+        websocket,
+        encoding=negotiate(request.get("encoding")),
+        compression=negotiate_compression(request.get("compression")),
+    )
     try:
-        if user.id not in connected_users:
-            connected_users[user.id] = 1
-            await get_pool("users").broadcast({
-                "type": "connect",
-                "id": user.id,
-            })
-        else:
-            connected_users[user.id] += 1
+        connection.lease_id = await presence.connect(user.id)
         while True:
             await handle_ws_request(connection, await websocket.receive_json())
     except starlette.websockets.WebSocketDisconnect:
@@ -164,14 +214,9 @@ async def live_connection(websocket: WebSocket):
         # Remove this connection from all pools
         for pool in connection.pools:
             pool.discard(connection)
-        # Send a presence notification
-        connected_users[user.id] -= 1
-        if connected_users[user.id] == 0:
-            del connected_users[user.id]
-            await get_pool("users").broadcast({
-                "type": "disconnect",
-                "id": user.id,
-            })
+        # Let the lease run out, unless the user reconnects
+        if connection.lease_id is not None:
+            await presence.disconnect(connection.lease_id)
 
 
 @app.post("/api/status")
@@ -197,5 +242,20 @@ async def show_window(request: ShowWindowRequest):
     return {"status": "success"}
 
 
+def run_broker():
+    asyncio.run(Broker(BACKPLANE_SOCKET).serve())
+
+
 if __name__ == '__main__':
-    uvicorn.run(app, port=80, host="0.0.0.0")
+    if WORKERS > 1:
+        if BACKPLANE == "unix":
+            threading.Thread(target=run_broker, daemon=True).start()
+        uvicorn.run(
+            f"{__package__}.__main__:app",
+            port=80,
+            host="0.0.0.0",
+            workers=WORKERS,
+            ws_per_message_deflate=WS_COMPRESSION == "transport",
+        )
+    else:
+        uvicorn.run(app, port=80, host="0.0.0.0", ws_per_message_deflate=WS_COMPRESSION == "transport")
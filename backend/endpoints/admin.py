@@ -1,6 +1,8 @@
+import os
 from fastapi import APIRouter
 
-from ..lib import database
+from ..lib import database, wire
+from ..lib.blobs import DEDUPLICATE_FILES, blob_stats, collect_blobs
 from ..lib.errors import JsonError
 from ..lib.security import hash_password
 from ..models.database_models import User
@@ -26,3 +28,30 @@ async def admin_create_request(request: CreateAdminRequest):
 @router.post("/list-users")
 async def admin_create_request(request: AdminConsoleRequest):
     return {"status": "success", "users": [user.name for user in database.users.find()]}
+
+
+@router.post("/file-store")
+async def admin_file_store(request: AdminConsoleRequest):
+    return {"status": "success", "enabled": DEDUPLICATE_FILES, **blob_stats()}
+
+
+@router.post("/file-store/collect")
+async def admin_file_store_collect(request: AdminConsoleRequest):
+    return {"status": "success", "freed_bytes": collect_blobs()}
+
+
+@router.post("/websockets")
+async def admin_websockets(request: AdminConsoleRequest):
+    # Metrics are per worker process
+    return {
+        "status": "success",
+        "worker": os.getpid(),
+        "compression": {
+            "mode": wire.WS_COMPRESSION,
+            "threshold": wire.WS_COMPRESSION_THRESHOLD,
+            "level": wire.WS_COMPRESSION_LEVEL,
+            "window_bits": wire.WS_COMPRESSION_WINDOW_BITS,
+            "context_takeover": wire.WS_COMPRESSION_CONTEXT_TAKEOVER,
+            **wire.compression_metrics.report(),
+        },
+    }
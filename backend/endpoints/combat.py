@@ -1,19 +1,60 @@
 import secrets
 import random
-from fastapi import APIRouter
+from bson import ObjectId
+from fastapi import APIRouter, BackgroundTasks
 from typing import Optional
 
-from ..lib import database
+from ..lib import database, expressions
+from ..lib.combat import combat_engine
 from ..lib.errors import JsonError
 from ..lib.game import send_message
 from ..lib.utils import require, auth_require
-from ..models.database_models import Combat, Permissions
+from ..models.database_models import Character, Combat, Combatant, Permissions, User
 from ..models.request_models import AuthRequest, GMRequest
 
 
 router = APIRouter()
 
 
+def versioned(update: dict) -> dict:
+    """
+    Add a version increment to an update, so in-flight turn changes based on
+    the old state are rejected. The version is only ever changed this way.
+    """
+    for operator, fields in update.items():
+        if not isinstance(fields, dict):
+            raise JsonError("invalid changes")
+        targets = list(fields)
+        if operator == "$rename":
+            targets.extend(target for target in fields.values() if isinstance(target, str))
+        if any(target == "version" or target.startswith("version.") for target in targets):
+            raise JsonError("changes may not touch version")
+    update = dict(update)
+    update["$inc"] = {**update.get("$inc", {}), "version": 1}
+    return update
+
+
+async def start_turn(combatant: Combatant, user: User, reset_actions: bool = True):
+    """
+    Announce the start of a combatant's turn and refresh its character's
+    action economy. Runs after the turn change has been answered.
+    """
+    await send_message(
+        f'<div class="turn-start">Turn Start: {combatant.name}</div>',
+        user=user,
+    )
+    if not reset_actions:
+        return
+    character = database.characters.find_one(combatant.character_id)
+    if character:
+        changes = {"$set": {
+            "actions": character.max_actions,
+            "reactions": character.max_reactions,
+        }}
+        database.characters.find_one_and_update(character.id, changes)
+        await character.broadcast_changes(changes)
+
+
 class NewCombatRequest(GMRequest):
     name: str
 
@@ -33,14 +74,16 @@ class GetCombatRequest(AuthRequest):
 
 @router.post("/get")
 async def combat_get(request: GetCombatRequest):
-    combat = database.combats.find_one(request.id)
+    active = combat_engine.get(request.id)
 
-    if combat is None:
+    if active is None:
         raise JsonError("invalid combat id")
+    async with combat_engine.locked(active):
+        combat = active.combat.model_dump()
 
     return {
         "status": "success",
-        "combat": combat.model_dump(),
+        "combat": combat,
     }
 
 
@@ -51,13 +94,14 @@ class CombatUpdateRequest(AuthRequest):
 
 @router.post("/update")
 async def combat_update(request: CombatUpdateRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+    active = require(combat_engine.get(request.id), "invalid combat id")
     if not request.requester.is_gm:
-        auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
+        auth_require(active.combat.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    database.combats.find_one_and_update(request.id, request.changes)
+    async with combat_engine.locked(active):
+        event = require(await combat_engine.update(active, versioned(request.changes)), "invalid combat id")
 
-    await combat.broadcast_changes(request.changes)
+    await combat_engine.publish(active, event)
     return {"status": "success"}
 
 
@@ -67,20 +111,17 @@ class CombatSortRequest(AuthRequest):
 
 @router.post("/sort")
 async def combat_sort(request: CombatSortRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
-    require(len(combat.combatants) > 0, "not enough combatants")
+    active = require(combat_engine.get(request.id), "invalid combat id")
     if not request.requester.is_gm:
-        auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
-
-    combatants = combat.combatants
-    combatants.sort(key=lambda c: c.initiative if c.initiative else 0, reverse=True)
+        auth_require(active.combat.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    update = {"$set": {
-        "combatants": [c.model_dump() for c in combatants],
-    }}
+    async with combat_engine.locked(active):
+        require(len(active.combat.combatants) > 0, "not enough combatants")
+        combatants = list(active.combat.combatants)
+        combatants.sort(key=lambda c: c.initiative if c.initiative else 0, reverse=True)
+        event = combat_engine.set_order(active, combatants)
 
-    database.combats.find_one_and_update(request.id, update)
-    await combat.broadcast_changes(update)
+    await combat_engine.publish(active, event)
 
     return {"status": "success"}
 
@@ -91,41 +132,80 @@ class CombatShuffleRequest(AuthRequest):
 
 @router.post("/shuffle")
 async def combat_sort(request: CombatShuffleRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
-    require(len(combat.combatants) > 0, "not enough combatants")
+    active = require(combat_engine.get(request.id), "invalid combat id")
     if not request.requester.is_gm:
-        auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
-
-    combatants = list(combat.combatants)
-    random.shuffle(combatants)
+        auth_require(active.combat.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    update = {"$set": {
-        "combatants": [c.model_dump() for c in combatants],
-    }}
+    async with combat_engine.locked(active):
+        require(len(active.combat.combatants) > 0, "not enough combatants")
+        combatants = list(active.combat.combatants)
+        random.shuffle(combatants)
+        event = combat_engine.set_order(active, combatants)
 
-    database.combats.find_one_and_update(request.id, update)
-    await combat.broadcast_changes(update)
+    await combat_engine.publish(active, event)
 
     return {"status": "success"}
 
 
+class RollInitiativeRequest(AuthRequest):
+    id: str
+
+
+@router.post("/roll-initiative")
+async def combat_roll_initiative(request: RollInitiativeRequest):
+    active = require(combat_engine.get(request.id), "invalid combat id")
+    if not request.requester.is_gm:
+        auth_require(active.combat.has_permission(request.requester.id, "*", Permissions.WRITE))
+
+    async with combat_engine.locked(active):
+        combatants = list(active.combat.combatants)
+        require(len(combatants) > 0, "not enough combatants")
+
+        # Load every linked character's formula and values at once
+        character_ids = {combatant.character_id for combatant in combatants if combatant.character_id}
+        characters = {
+            character.id: character
+            for character in database.characters.find(
+                {"_id": {"$in": [ObjectId(id) for id in character_ids]}},
+                projection={"initiative": True, "data": True},
+                model=Character,
+            )
+        }
+
+        initiatives = {}
+        for combatant in combatants:
+            character = characters.get(combatant.character_id, None)
+            formula = character.initiative if character else Character.model_fields["initiative"].default
+            try:
+                initiatives[combatant.id] = expressions.evaluate(formula, character.data if character else None)
+            except Exception as e:
+                raise JsonError(f"invalid initiative for {combatant.name}: {e}")
+
+        for combatant in combatants:
+            combatant.initiative = initiatives[combatant.id]
+        combatants.sort(key=lambda c: c.initiative, reverse=True)
+        event = combat_engine.set_order(active, combatants, "initiative", initiatives=initiatives)
+
+    await combat_engine.publish(active, event)
+
+    return {"status": "success", "initiatives": initiatives}
+
+
 class CombatClearRequest(AuthRequest):
     id: str
 
 
 @router.post("/clear")
 async def combat_clear(request: CombatClearRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
-    require(len(combat.combatants) > 0, "not enough combatants")
+    active = require(combat_engine.get(request.id), "invalid combat id")
     if not request.requester.is_gm:
-        auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
+        auth_require(active.combat.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    update = {"$set": {
-        "combatants": [],
-    }}
+    async with combat_engine.locked(active):
+        require(len(active.combat.combatants) > 0, "not enough combatants")
+        event = combat_engine.clear(active)
 
-    database.combats.find_one_and_update(request.id, update)
-    await combat.broadcast_changes(update)
+    await combat_engine.publish(active, event)
 
     return {"status": "success"}
 
@@ -136,10 +216,11 @@ class AnnounceTurnRequest(AuthRequest):
 
 @router.post("/announce-turn")
 async def combat_announce_turn(request: AnnounceTurnRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+    active = require(combat_engine.get(request.id), "invalid combat id")
     auth_require(request.requester.is_gm)
-    require(len(combat.combatants) > 0, "not enough combatants")
-    combatant = combat.combatants[0]
+    async with combat_engine.locked(active):
+        require(len(active.combat.combatants) > 0, "not enough combatants")
+        combatant = active.combat.combatants[0]
     await send_message(
         f'<div class="turn-start">Turn Start: {combatant.name}</div>',
         user=request.requester,
@@ -149,91 +230,92 @@ async def combat_announce_turn(request: AnnounceTurnRequest):
 
 class ReverseTurnRequest(AuthRequest):
     id: str
+    version: Optional[int] = None
 
 
 @router.post("/reverse-turn")
-async def combat_end_turn(request: ReverseTurnRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+async def combat_end_turn(request: ReverseTurnRequest, background_tasks: BackgroundTasks):
+    active = require(combat_engine.get(request.id), "invalid combat id")
     auth_require(request.requester.is_gm)
-    require(len(combat.combatants) > 1, "not enough combatants")
-    combatant = combat.combatants[-1]
-
-    database.combats.find_one_and_update(request.id, {
-        "$pull": {
-            "combatants": {
-                "id": combatant.id,
-            },
-        },
-    })
-    database.combats.find_one_and_update(request.id, {
-        "$push": {
-            "combatants": {
-                "$each": [combatant.model_dump()],
-                "$position": 0,
-            }
-        }
-    })
 
-    await combat.pool.broadcast({"type": "reverse-turn", "id": combatant.id})
-    await send_message(
-        f'<div class="turn-start">Turn Start: {combatant.name}</div>',
-        user=request.requester,
-    )
+    async with combat_engine.locked(active):
+        require(len(active.combat.combatants) > 1, "not enough combatants")
+        require(request.version is None or request.version == active.combat.version, "combat was changed by someone else, try again")
+        combatant, event = combat_engine.reverse_turn(active)
+
+    await combat_engine.publish(active, event)
+    background_tasks.add_task(start_turn, combatant, request.requester, reset_actions=False)
     return {"status": "success"}
 
 
 class EndTurnRequest(AuthRequest):
     id: str
+    version: Optional[int] = None
 
 
 @router.post("/end-turn")
-async def combat_end_turn(request: EndTurnRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
-    require(len(combat.combatants) >= 1, "not enough combatants")
-    combatant = combat.combatants[0]
-    character = database.characters.find_one(combatant.character_id)
-    if not request.requester.is_gm:
-        if character is not None:
-            auth_require(
-                combat.has_permission(request.requester.id, "*", Permissions.WRITE)
-                or
-                character.has_permission(request.requester.id, "*", Permissions.OWNER)
-            )
-        else:
-            auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
-
-    combat = database.combats.find_one_and_update(request.id, {
-        "$pull": {
-            "combatants": {
-                "id": combatant.id,
-            },
-        },
-    })
-    combat = database.combats.find_one_and_update(request.id, {
-        "$push": {
-            "combatants": combatant.model_dump()
-        }
-    })
+async def combat_end_turn(request: EndTurnRequest, background_tasks: BackgroundTasks):
+    active = require(combat_engine.get(request.id), "invalid combat id")
+
+    async with combat_engine.locked(active):
+        combat = active.combat
+        require(len(combat.combatants) >= 1, "not enough combatants")
+        require(request.version is None or request.version == combat.version, "combat was changed by someone else, try again")
+        combatant = combat.combatants[0]
+        if not request.requester.is_gm:
+            character = database.characters.find_one(combatant.character_id)
+            if character is not None:
+                auth_require(
+                    combat.has_permission(request.requester.id, "*", Permissions.WRITE)
+                    or
+                    character.has_permission(request.requester.id, "*", Permissions.OWNER)
+                )
+            else:
+                auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
+
+        _, event = combat_engine.end_turn(active)
+        next_combatant = combat.combatants[0]
+
+    await combat_engine.publish(active, event)
+    background_tasks.add_task(start_turn, next_combatant, request.requester)
+    return {"status": "success"}
 
-    next_combatant = combat.combatants[0]
-    next_character = database.characters.find_one(next_combatant.character_id)
 
-    await combat.pool.broadcast({"type": "end-turn", "id": combatant.id})
+class UndoTurnsRequest(GMRequest):
+    id: str
+    count: int = 1
 
-    await send_message(
-        f'<div class="turn-start">Turn Start: {combat.combatants[0].name}</div>',
-        user=request.requester,
-    )
 
-    if next_character:
-        changes = {"$set": {
-            "actions": next_character.max_actions,
-            "reactions": next_character.max_reactions,
-        }}
-        database.characters.find_one_and_update(next_character.id, changes)
-        await next_character.broadcast_changes(changes)
+@router.post("/undo")
+async def combat_undo_turns(request: UndoTurnsRequest):
+    active = require(combat_engine.get(request.id), "invalid combat id")
+    require(request.count >= 1, "count must be positive")
 
-    return {"status": "success"}
+    async with combat_engine.locked(active):
+        event = require(combat_engine.undo_turns(active, request.count), "no turn changes to undo")
+
+    await combat_engine.publish(active, event)
+    return {"status": "success", "undone": len(event.data["undoes"])}
+
+
+class CombatEventsRequest(AuthRequest):
+    id: str
+    since: int
+
+
+@router.post("/events")
+async def combat_events(request: CombatEventsRequest):
+    active = require(combat_engine.get(request.id), "invalid combat id")
+    async with combat_engine.locked(active):
+        events = combat_engine.events_since(active, request.since)
+        version = active.combat.version
+    if events is None:
+        return {"status": "success", "resync": True, "version": version}
+    return {
+        "status": "success",
+        "events": [event.broadcast_dict() for event in events],
+        "version": version,
+    }
 
 
 @router.post("/list")
@@ -241,7 +323,7 @@ async def combat_list(request: AuthRequest):
     return {
         "status": "success",
         "combats": [
-            combat.model_dump()
+            combat_engine.cached(combat).model_dump()
             for combat in database.combats.find()
         ],
     }
@@ -258,13 +340,14 @@ class AddCombatantRequest(AuthRequest):
 async def add_combatant(request: AddCombatantRequest):
     if request.combat_id is None:
         combat = require(database.combats.find_one({}), "no combat")
+        active = require(combat_engine.get(combat.id), "no combat")
     else:
-        combat = require(database.combats.find_one(request.combat_id), "invalid combat id")
+        active = require(combat_engine.get(request.combat_id), "invalid combat id")
 
     auth_require(
         request.requester.is_gm
         or
-        combat.has_permission(request.requester.id, "*", Permissions.WRITE)
+        active.combat.has_permission(request.requester.id, "*", Permissions.WRITE)
     )
 
     require(request.character_id is not None or request.name is not None, "name or character_id is required")
@@ -281,11 +364,8 @@ async def add_combatant(request: AddCombatantRequest):
     if request.name is not None:
         combatant["name"] = request.name
 
-    update = {
-        "$push": {
-            "combatants": combatant
-        }
-    }
-    database.combats.find_one_and_update(combat.id, update)
-    await combat.broadcast_changes(update)
+    async with combat_engine.locked(active):
+        event = combat_engine.add_combatant(active, Combatant.model_validate(combatant))
+
+    await combat_engine.publish(active, event)
     return {"status": "success", "id": combatant_id}
@@ -1,11 +1,27 @@
-import shutil
-from fastapi import APIRouter, Form, UploadFile, File
+import asyncio
+import base64
+import json
+import os
+from fastapi import APIRouter, BackgroundTasks, Form, Header, UploadFile, File
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
 from pathlib import Path
+from stat import S_ISREG
+from typing import Literal, Optional
+from urllib.parse import quote
 
 from ..lib import database
+from ..lib.archives import MAX_ARCHIVE_SIZE, extract_archive, stream_zip
 from ..lib.errors import AuthError, JsonError
-from ..lib.files import sniff, validate_directory, validate_path, generate_thumbnail, delete_thumbnail
-from ..models.database_models import Session, User, get_pool
+from ..lib.jobs import cancel_file_job, start_file_job, delete_tree
+from ..lib.utils import require, auth_require, etag_matches
+from ..lib.watcher import file_index
+from ..lib.files import (
+    FILES_ACCEL_REDIRECT, SORT_KEY_TYPES, THUMBNAILS_DIR, upload_limit, save_upload,
+    list_directory, find_file_record, get_file_record, validate_directory, validate_path, resolve_file_url,
+    ListedFile, is_internal_path, has_thumbnails, find_thumbnails, queue_thumbnails, select_thumbnail_profile,
+    staging_path, store_upload, move_records,
+)
+from ..models.database_models import FILES_ROOT, Session, User, get_pool
 from ..models.request_models import AuthRequest
 
 
@@ -25,6 +41,7 @@ async def files_mkdir(request: CreateFolderRequest):
         new_path.mkdir()
     except FileExistsError:
         raise JsonError("directory already exists")
+    await file_index.refresh(path)
     await get_pool("files").broadcast({
         "type": "mkdir",
         "user": request.requester.id,
@@ -33,16 +50,6 @@ async def files_mkdir(request: CreateFolderRequest):
     return {"status": "success"}
 
 
-def recursive_delete(path: Path):
-    if path.is_dir():
-        for sub_path in list(path.iterdir()):
-            recursive_delete(sub_path)
-        path.rmdir()
-    else:
-        path.unlink()
-        delete_thumbnail(path)
-
-
 class DeleteFileRequest(AuthRequest):
     path: str
 
@@ -51,19 +58,41 @@ class DeleteFileRequest(AuthRequest):
 async def delete_file(request: DeleteFileRequest):
     path = validate_path(request.requester, request.path)
     # Check that path is a file or directory that exists
-    if not path.exists():
+    if not path.exists() and not path.is_symlink():
         raise JsonError("path does not exist")
-    recursive_delete(path)
-    await get_pool("files").broadcast({
-        "type": "delete",
-        "user": request.requester.id,
-        "path": request.path,
-    })
+    job = start_file_job(
+        "delete", request.requester.id, request.path, delete_tree, path,
+        on_finish=lambda: file_index.refresh(path.parent),
+    )
+    return {"status": "success", "job": job.id}
+
+
+class FileJobRequest(AuthRequest):
+    id: str
+
+
+@router.post("/jobs/cancel")
+async def cancel_job(request: FileJobRequest):
+    job = require(database.file_jobs.find_one(request.id), "invalid job id")
+    auth_require(request.requester.is_gm or job.user == request.requester.id)
+    if job.status == "running":
+        await cancel_file_job(job.id)
     return {"status": "success"}
 
 
-@router.post("/upload")
-async def upload_file(token: str = Form(...), path: str = Form(...), file: UploadFile = File(...)):
+@router.post("/jobs/list")
+async def list_file_jobs(request: AuthRequest):
+    filter = {} if request.requester.is_gm else {"user": request.requester.id}
+    return {
+        "status": "success",
+        "jobs": [
+            job.model_dump(exclude={"finished"})
+            for job in database.file_jobs.find(filter, sort=[("_id", 1)])
+        ],
+    }
+
+
+def resolve_token(token: str) -> User:
     session: Session = database.sessions.find_one({"auth_token": token})
     if session is None:
         raise AuthError("invalid token")
@@ -72,11 +101,29 @@ async def upload_file(token: str = Form(...), path: str = Form(...), file: Uploa
     if requester is None:
         raise AuthError("valid token for deleted user")
 
+    return requester
+
+
+@router.post("/upload")
+async def upload_file(background_tasks: BackgroundTasks, token: str = Form(...), path: str = Form(...), file: UploadFile = File(...)):
+    requester = resolve_token(token)
+
     resolved_path = validate_directory(requester, path)
+    require(file.filename and file.filename == Path(file.filename).name, "invalid filename")
+    destination = resolved_path / file.filename
+
+    # Reject uploads that are known to be too big before reading them
+    limit = upload_limit(requester, destination)
+    if file.size is not None and file.size > limit:
+        raise JsonError(f"upload exceeds limit of {limit} bytes")
+
+    # Stream the file to its permanent location, hashing it on the way
+    content_hash = await save_upload(file, destination, limit)
 
-    # Copy file to permanent location
-    with open(resolved_path / file.filename, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    # Deduplicate and index the contents and thumbnail the file after responding
+    store_upload(destination, content_hash)
+    await file_index.refresh(resolved_path)
+    queue_thumbnails(background_tasks, [destination])
 
     await get_pool("files").broadcast({
         "type": "upload",
@@ -86,6 +133,38 @@ async def upload_file(token: str = Form(...), path: str = Form(...), file: Uploa
     return {"status": "success"}
 
 
+@router.post("/upload-archive")
+async def upload_archive(token: str = Form(...), path: str = Form(...), file: UploadFile = File(...)):
+    requester = resolve_token(token)
+    destination = validate_directory(requester, path)
+    limit = upload_limit(requester, destination, MAX_ARCHIVE_SIZE)
+    # The archive itself can't be any larger than what it may extract to
+    if file.size is not None and file.size > limit:
+        raise JsonError(f"upload exceeds limit of {limit} bytes")
+
+    # Keep a copy of the archive, the upload is closed once this returns
+    archive_path = staging_path(".archive")
+    await save_upload(file, archive_path, limit)
+
+    job = start_file_job(
+        "extract", requester.id, path, extract_archive, archive_path, destination, limit,
+        on_finish=lambda: file_index.refresh(destination),
+    )
+    return {"status": "success", "job": job.id}
+
+
+@router.get("/download-archive")
+async def download_archive(token: str, path: str):
+    requester = resolve_token(token)
+    root = validate_directory(requester, path)
+    name = root.name if root != requester.file_root else "files"
+    return StreamingResponse(
+        stream_zip(root),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{name}.zip"'},
+    )
+
+
 class MoveFileRequest(AuthRequest):
     src: str
     dst: str
@@ -97,6 +176,9 @@ async def move_file(request: MoveFileRequest):
     src = validate_path(request.requester, request.src)
     dst = validate_path(request.requester, request.dst)
     src.rename(dst)
+    await file_index.refresh(src.parent)
+    await file_index.refresh(dst.parent)
+    move_records(src, dst)
     await get_pool("files").broadcast({
         "type": "rename",
         "user": request.requester.id,
@@ -108,10 +190,36 @@ async def move_file(request: MoveFileRequest):
 
 class ListFilesRequest(AuthRequest):
     path: str
+    sort: Literal["type", "name", "mtime", "size"] = "type"
+    reverse: bool = False
+    limit: Optional[int] = None
+    cursor: Optional[str] = None
+    metadata: bool = False
+
+
+def encode_cursor(sort: str, key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"sort": sort, "key": key}).encode()).decode()
+
+
+def decode_cursor(sort: str, cursor: str) -> tuple:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        key = tuple(data["key"])
+    except (ValueError, TypeError, KeyError):
+        raise JsonError("invalid cursor")
+    require(data.get("sort") == sort, "cursor is for a different sort")
+    # The key is compared with the keys of the directory's entries
+    types = SORT_KEY_TYPES.get(sort)
+    if types is None or len(key) != len(types) or not all(
+        isinstance(part, part_type) and not isinstance(part, bool)
+        for part, part_type in zip(key, types)
+    ):
+        raise JsonError("invalid cursor")
+    return key
 
 
 @router.post("/list")
-async def list_files(request: ListFilesRequest):
+async def list_files(request: ListFilesRequest, background_tasks: BackgroundTasks):
     # Validate path
     path = validate_directory(request.requester, request.path)
     # Make path relative to user root
@@ -122,25 +230,91 @@ async def list_files(request: ListFilesRequest):
     else:
         returned_path = "/" + str(path.relative_to(user_root))
 
-    results = [
-        (
-            sniff(subpath),
-            "/" + str(subpath.relative_to(user_root))
-        )
-        for subpath in path.iterdir()
-    ]
-    results.sort()
-
-    for file_type, file_path in results:
-        if file_type == "image/gif":
-            pass # Don't thumbnail GIFs
-        elif file_type == "image/svg":
-            generate_thumbnail(user_root / file_path.lstrip("/"), svg=True)
-        elif file_type.startswith("image/"):
-            generate_thumbnail(user_root / file_path.lstrip("/"))
+    if request.limit is not None:
+        require(request.limit > 0, "limit must be positive")
+    after = None
+    if request.cursor is not None:
+        after = decode_cursor(request.sort, request.cursor)
+
+    page, next_key = list_directory(file_index.entries(path), request.sort, request.reverse, request.limit, after)
+
+    results = []
+    for _, entry in page:
+        file_type = entry.type
+        file_path = "/" + str(Path(entry.path).relative_to(user_root))
+        if request.metadata:
+            results.append((file_type, file_path, entry.stat.st_size, entry.stat.st_mtime))
+        else:
+            results.append((file_type, file_path))
+
+    # Only list thumbnails that already exist, the rest are generated after
+    # responding and show up in later listings
+    images = [entry for _, entry in page if has_thumbnails(entry.type)]
+    found = find_thumbnails(images)
+    queue_thumbnails(background_tasks, [Path(entry.path) for entry in images if entry.path not in found])
+    thumbnails = {
+        "/" + str(Path(entry_path).relative_to(user_root)): [
+            {"size": profile.size, "format": profile.format, "url": f"/{THUMBNAILS_DIR.name}/{name}"}
+            for profile, name in variants
+        ]
+        for entry_path, variants in found.items()
+    }
 
     return {
         "status": "success",
         "path": returned_path,
-        "files": results
+        "files": results,
+        "thumbnails": thumbnails,
+        "cursor": encode_cursor(request.sort, next_key) if next_key is not None else None,
     }
+
+
+@router.get("/thumbnail")
+async def get_thumbnail(url: str, size: int = 128):
+    # Only redirect to URLs built from paths known to be ours, never to the
+    # URL as given
+    parts = Path(os.path.normpath(url)).parts
+    if len(parts) == 3 and parts[0] == "/" and parts[1] == THUMBNAILS_DIR.name:
+        return RedirectResponse(f"/{THUMBNAILS_DIR.name}/{quote(parts[2])}")
+    path = resolve_file_url(url)
+    if path is None or is_internal_path(path) or not path.is_file():
+        return Response(status_code=404)
+    original = f"/{FILES_ROOT.name}/{quote(str(path.relative_to(FILES_ROOT)))}"
+    entry = ListedFile(path.name, str(path), path.stat())
+    if not has_thumbnails(entry.type):
+        return RedirectResponse(original)
+    variants = find_thumbnails([entry]).get(entry.path)
+    if variants is None:
+        # Listing or uploading the file queues its thumbnails, and the
+        # original does until then
+        return RedirectResponse(original)
+    name = dict(variants)[select_thumbnail_profile(size)]
+    return RedirectResponse(f"/{THUMBNAILS_DIR.name}/{name}")
+
+
+@router.get("/raw/{path:path}")
+async def get_raw_file(path: str, if_none_match: Optional[str] = Header(None)):
+    file_path = resolve_file_url(f"/{FILES_ROOT.name}/{path}")
+    if file_path is None or is_internal_path(file_path):
+        return Response(status_code=404)
+    try:
+        stat = file_path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return Response(status_code=404)
+    if not S_ISREG(stat.st_mode):
+        return Response(status_code=404)
+
+    # The content hash makes a strong validator, unlike nginx's mtime-size
+    # ETags. Files that aren't indexed yet are hashed off the event loop.
+    record = find_file_record(file_path, stat)
+    if record is None:
+        record = await asyncio.to_thread(get_file_record, file_path, stat)
+    etag = f'"{record.hash}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if FILES_ACCEL_REDIRECT:
+        headers["X-Accel-Redirect"] = FILES_ACCEL_REDIRECT + quote(str(file_path.relative_to(FILES_ROOT)))
+        return Response(headers=headers)
+    # FileResponse takes care of Range and If-Range requests
+    return FileResponse(file_path, headers=headers, stat_result=stat)
@@ -1,40 +1,96 @@
+import hashlib
+import json
 from bson import ObjectId
 from bson.errors import InvalidId
+from collections import OrderedDict
 from fastapi import APIRouter
 from pydantic.functional_validators import AfterValidator
-from typing import Annotated, Optional
+from typing import Annotated, List, Optional
 from enum import Enum
 
 from ..lib import database
 from ..lib.utils import require, auth_require, pluralize
-from ..models.database_models import Permissions, get_pool, Entry, Folder
+from ..models.database_models import Permissions, broadcast_to_pools, get_pool, AbilityStub, Entry, EntryStub, Folder
 from ..models.request_models import AuthRequest, GMRequest
 
 
+def folder_subtree(collection: str, folder: Folder, session=None) -> list[str]:
+    """
+    Get the ids of a folder and all of its descendants with one indexed query
+    on the materialized ancestors.
+    """
+    folders: database.DocumentCollection[Folder] = getattr(database, f"{collection}_folders")
+    return [folder.id] + [
+        str(document["_id"])
+        for document in folders.collection.find({"ancestors": folder.id}, {"_id": True}, session=session)
+    ]
+
+
 def delete_folder(collection: str, folder: Folder):
-    # Delete the folder itself
     folders: database.DocumentCollection[Folder] = getattr(database, f"{collection}_folders")
-    folders.delete_one(folder.id)
-    # Delete all entries in this folder
     entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(collection)}")
-    entryCollection.delete_many({"folder_id": folder.id})
-    # Recursively delete all child folders
-    for subfolder in folders.find({"parent_id": folder.id}):
-        delete_folder(collection, subfolder)
+    with database.transaction() as session:
+        folder_ids = folder_subtree(collection, folder, session)
+        # Delete all entries in the folder and its subfolders
+        entryCollection.delete_many({"folder_id": {"$in": folder_ids}}, session=session)
+        # Delete the folder and its subfolders
+        folders.delete_many({"_id": {"$in": [ObjectId(id) for id in folder_ids]}}, session=session)
 
 
-def set_folder_permissions(collection: str, folder: Folder, permissions: dict):
+async def set_folder_permissions(collection: str, folder: Folder, permissions: dict):
+    folders: database.DocumentCollection[Folder] = getattr(database, f"{collection}_folders")
     entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(collection)}")
-    entryCollection.update_many({"folder_id": folder.id}, {"$set": {"permissions": permissions}})
+    with database.transaction() as session:
+        folder_ids = folder_subtree(collection, folder, session)
+        entry_ids = [
+            str(document["_id"])
+            for document in entryCollection.collection.find({"folder_id": {"$in": folder_ids}}, {"_id": True}, session=session)
+        ]
+        entryCollection.update_many({"folder_id": {"$in": folder_ids}}, {"$set": {"permissions": permissions}}, session=session)
+        folders.update_many({"_id": {"$in": [ObjectId(id) for id in folder_ids]}}, {"$set": {"permissions": permissions}}, session=session)
+
+    # Windows for an entry may be subscribed on any worker, which each pass
+    # this on to the entries they have pools for
+    await broadcast_to_pools(entry_ids, {
+        "type": "update",
+        "changes": {"$set": {"permissions": permissions}},
+    })
+    # The parent lists the folder itself, so its listing may change too
+    await get_pool(pluralize(collection)).broadcast({
+        "type": "permissions",
+        "folders": [folder.parent_id] + folder_ids,
+    })
 
-    folders: database.DocumentCollection[Folder] = getattr(database, f"{collection}_folders")
-    for subfolder in folders.find({"parent_id": folder.id}):
-        set_folder_permissions(collection, subfolder, permissions)
 
-    return {"status": "success"}
+router = APIRouter()
+STUB_PROJECTION = {"name": True, "image": True, "permissions": True, "folder_id": True}
+# Entry types whose list renderers need more than the common fields
+ENTRY_STUBS = {
+    "ability": ({**STUB_PROJECTION, "type": True, "cooldown": True}, AbilityStub),
+}
 
 
-router = APIRouter()
+def find_stubs(entryType: str, entryCollection: database.DocumentCollection[Entry], filter: dict) -> List[EntryStub]:
+    projection, model = ENTRY_STUBS.get(entryType, (STUB_PROJECTION, EntryStub))
+    return entryCollection.find(filter, projection=projection, model=model)
+
+
+def readable_filter(request: AuthRequest, filter: dict) -> dict:
+    if request.requester.is_gm:
+        return filter
+    return {"$and": [filter, Entry.permission_filter(request.requester.id, level=Permissions.READ)]}
+
+
+def find_folder(folders: database.DocumentCollection[Folder], folder_id: str) -> Folder:
+    try:
+        return require(folders.find_one({"$or": [
+            {"_id": ObjectId(folder_id)},
+            {"alternate_id": folder_id},
+        ]}), "invalid folder id")
+    except InvalidId:
+        return require(folders.find_one({
+            "alternate_id": folder_id
+        }), "invalid folder id")
 
 
 def validate_entry_type(value: str):
@@ -57,6 +113,7 @@ async def folder_move(request: FolderMoveRequest, entryType: EntryType):
     folders: database.DocumentCollection[Folder] = getattr(database, f"{entryType}_folders")
     entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(entryType)}")
 
+    dst_folder = None
     if request.dst_id is not None:
         dst_folder = require(folders.find_one(request.dst_id), "invalid folder id")
         if not request.requester.is_gm:
@@ -89,9 +146,26 @@ async def folder_move(request: FolderMoveRequest, entryType: EntryType):
         require(request.folder_id != request.dst_id, "folder cannot contain itself")
         folder = require(folders.find_one(request.folder_id), "invalid folder id")
         require(folder.parent_id != request.dst_id, "src and dst folder must differ")
+        if dst_folder is not None:
+            require(folder.id not in dst_folder.ancestors, "folder cannot contain itself")
         if not request.requester.is_gm:
             auth_require(folder.has_permission(request.requester.id, "*", Permissions.OWNER))
-        folders.find_one_and_update(request.folder_id, {"$set": {"parent_id": request.dst_id}})
+        ancestors = dst_folder.ancestors + [dst_folder.id] if dst_folder is not None else []
+        with database.transaction() as session:
+            folders.find_one_and_update(
+                request.folder_id,
+                {"$set": {"parent_id": request.dst_id, "ancestors": ancestors}},
+                session=session,
+            )
+            # Replace the part of each descendant's ancestors above the moved folder
+            folders.update_many({"ancestors": folder.id}, [{"$set": {"ancestors": {"$concatArrays": [
+                ancestors,
+                {"$slice": [
+                    "$ancestors",
+                    {"$indexOfArray": ["$ancestors", folder.id]},
+                    {"$size": "$ancestors"},
+                ]},
+            ]}}}], session=session)
         await get_pool(pluralize(entryType)).broadcast({
             "type": "movedir",
             "src": folder.parent_id,
@@ -104,6 +178,7 @@ async def folder_move(request: FolderMoveRequest, entryType: EntryType):
 
 class ListRequest(AuthRequest):
     folder_id: Optional[str] = None
+    full: bool = False
 
 
 @router.post("/{entryType}/list")
@@ -112,16 +187,7 @@ async def folder_list(request: ListRequest, entryType: EntryType):
     entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(entryType)}")
 
     if request.folder_id is not None:
-        try:
-            folder = require(folders.find_one({"$or": [
-                {"_id": ObjectId(request.folder_id)},
-                {"alternate_id": request.folder_id},
-            ]}), "invalid folder id")
-        except InvalidId:
-            folder = require(folders.find_one({
-                "alternate_id": request.folder_id
-            }), "invalid folder id")
-
+        folder = find_folder(folders, request.folder_id)
         folder_id = folder.id
         folder_name = folder.name
         parent_id = folder.parent_id
@@ -130,16 +196,19 @@ async def folder_list(request: ListRequest, entryType: EntryType):
         folder_name = "/"
         parent_id = None
 
-    subfolders = []
-    for folder in folders.find({"parent_id": folder_id}):
-        if request.requester.is_gm or folder.has_permission(request.requester.id, level=Permissions.READ):
-            subfolders.append((folder.id, folder.name))
+    subfolders = [(folder.id, folder.name) for folder in folders.find(readable_filter(request, {"parent_id": folder_id}))]
     subfolders.sort(key=lambda f: f[1])
 
+    # Listings only need stubs unless the caller asks for whole entries
+    entry_filter = readable_filter(request, {"folder_id": folder_id})
+    if request.full:
+        found = entryCollection.find(entry_filter)
+    else:
+        found = find_stubs(entryType, entryCollection, entry_filter)
     entries = []
-    for entry in entryCollection.find({"folder_id": folder_id}):
-        if request.requester.is_gm or entry.has_permission(request.requester.id, level=Permissions.READ):
-            entries.append(entry.model_dump())
+    for entry in found:
+        entry.entry_type = entryType
+        entries.append(entry.model_dump())
     entries.sort(key=lambda entry: entry["name"])
 
     return {
@@ -151,6 +220,98 @@ async def folder_list(request: ListRequest, entryType: EntryType):
     }
 
 
+class TreeRequest(AuthRequest):
+    folder_id: Optional[str] = None
+    # ETag of the tree the client already has
+    since: Optional[str] = None
+
+
+# Recently served trees by requester and ETag, so clients that already have
+# one of them only get what changed since
+TREE_SNAPSHOTS = 64
+tree_snapshots: OrderedDict[tuple[str, str], tuple[dict[str, dict], dict[str, dict]]] = OrderedDict()
+
+
+def tree_changes(previous: dict[str, dict], current: dict[str, dict]) -> tuple[list[dict], list[str]]:
+    """
+    Get the items that were added or changed, and the ids of the items that
+    were removed, between two versions of a tree.
+    """
+    changed = [item for id, item in current.items() if previous.get(id) != item]
+    deleted = [id for id in previous if id not in current]
+    return changed, deleted
+
+
+@router.post("/{entryType}/tree")
+async def folder_tree(request: TreeRequest, entryType: EntryType):
+    folders: database.DocumentCollection[Folder] = getattr(database, f"{entryType}_folders")
+    entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(entryType)}")
+
+    if request.folder_id is not None:
+        folder = find_folder(folders, request.folder_id)
+        subtree = folders.find({"$or": [{"_id": ObjectId(folder.id)}, {"ancestors": folder.id}]})
+    else:
+        folder = None
+        subtree = folders.find({})
+
+    # Folders the requester can't read hide everything beneath them
+    hidden = set()
+    if not request.requester.is_gm:
+        for subfolder in subtree:
+            if not subfolder.has_permission(request.requester.id, level=Permissions.READ):
+                hidden.add(subfolder.id)
+    tree = [
+        {"id": subfolder.id, "name": subfolder.name, "parent_id": subfolder.parent_id}
+        for subfolder in subtree
+        if subfolder.id not in hidden and hidden.isdisjoint(subfolder.ancestors)
+    ]
+    tree.sort(key=lambda subfolder: (subfolder["name"], subfolder["id"]))
+
+    folder_ids = [subfolder["id"] for subfolder in tree]
+    if folder is None:
+        folder_ids.append(None)
+    entries = []
+    entry_filter = readable_filter(request, {"folder_id": {"$in": folder_ids}})
+    for entry in find_stubs(entryType, entryCollection, entry_filter):
+        entry.entry_type = entryType
+        entries.append(entry.model_dump())
+    entries.sort(key=lambda entry: (entry["name"], entry["id"]))
+
+    root_id = folder.id if folder is not None else None
+    etag = hashlib.sha256(json.dumps([entryType, root_id, tree, entries]).encode()).hexdigest()
+    current = ({subfolder["id"]: subfolder for subfolder in tree}, {entry["id"]: entry for entry in entries})
+    if request.since == etag:
+        previous = current
+    else:
+        previous = tree_snapshots.get((request.requester.id, request.since))
+    tree_snapshots[(request.requester.id, etag)] = current
+    tree_snapshots.move_to_end((request.requester.id, etag))
+    while len(tree_snapshots) > TREE_SNAPSHOTS:
+        tree_snapshots.popitem(last=False)
+    if previous is not None:
+        changed_folders, deleted_folders = tree_changes(previous[0], current[0])
+        changed_entries, deleted_entries = tree_changes(previous[1], current[1])
+        return {
+            "status": "success",
+            "etag": etag,
+            "id": root_id,
+            "changes": {
+                "folders": changed_folders,
+                "deleted_folders": deleted_folders,
+                "entries": changed_entries,
+                "deleted_entries": deleted_entries,
+            },
+        }
+
+    return {
+        "status": "success",
+        "etag": etag,
+        "id": root_id,
+        "folders": tree,
+        "entries": entries,
+    }
+
+
 class FolderRenameRequest(AuthRequest):
     id: str
     name: str
@@ -183,10 +344,12 @@ class FolderCreateRequest(AuthRequest):
 async def folder_create(request: FolderCreateRequest, entryType: EntryType):
     folders: database.DocumentCollection[Folder] = getattr(database, f"{entryType}_folders")
 
+    ancestors = []
     if request.parent is not None:
-        require(folders.find_one(request.parent), "invalid folder id")
+        parent = require(folders.find_one(request.parent), "invalid folder id")
+        ancestors = parent.ancestors + [parent.id]
 
-    options = {"name": request.name, "parent_id": request.parent}
+    options = {"name": request.name, "parent_id": request.parent, "ancestors": ancestors}
     if not request.requester.is_gm:
         options["permissions"] = {"*": {"*": Permissions.READ}, request.requester.id: {"*": Permissions.OWNER}}
 
@@ -249,6 +412,6 @@ async def folder_set_permissions(request: FolderUpdatePermissionsRequest, entryT
     folders: database.DocumentCollection[Folder] = getattr(database, f"{entryType}_folders")
     folder = require(folders.find_one(request.folder_id), "invalid folder id")
 
-    set_folder_permissions(entryType, folder, request.permissions)
+    await set_folder_permissions(entryType, folder, request.permissions)
 
     return {"status": "success"}
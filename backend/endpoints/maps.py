@@ -2,7 +2,7 @@ from fastapi import APIRouter
 
 from ..lib import database
 from ..lib.utils import require, auth_require
-from ..models.database_models import Permissions, get_pool
+from ..models.database_models import Permissions, EntryStub, Map, get_pool
 from ..models.request_models import AuthRequest, GMRequest
 
 
@@ -85,12 +85,9 @@ async def map_ping(request: MapPingRequest):
 
 @router.post("/list")
 async def map_list(request: AuthRequest):
-    maps = []
     if request.requester.is_gm:
-        for map in database.maps.find():
-            maps.append((map.id, map.name))
+        filter = {}
     else:
-        for map in database.maps.find():
-            if map.has_permission(request.requester.id, level=Permissions.READ):
-                maps.append((map.id, map.name))
+        filter = Map.permission_filter(request.requester.id, level=Permissions.READ)
+    maps = [(map.id, map.name) for map in database.maps.find(filter, projection={"name": True}, model=EntryStub)]
     return {"status": "success", "maps": maps}
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import tarfile
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import Callable, Iterator
+
+from .errors import JsonError
+from .files import UPLOAD_CHUNK_SIZE, is_internal_path, sniff, staging_path, store_upload, thumbnail_file
+
+
+MAX_ARCHIVE_ENTRIES = int(os.environ.get("MAX_ARCHIVE_ENTRIES") or 10000)
+MAX_ARCHIVE_SIZE = int(os.environ.get("MAX_ARCHIVE_SIZE") or 1024 * 1024 * 1024)
+MAX_COMPRESSION_RATIO = 100
+# Small members can legitimately compress far better than the ratio allows
+COMPRESSION_RATIO_GRACE = 1024 * 1024
+
+STORED_TYPES = {"image", "audio", "video", "archive"}
+
+
+def zip_members(archive: zipfile.ZipFile):
+    for info in archive.infolist():
+        yield info.filename, info.is_dir(), info.compress_size, lambda info=info: archive.open(info)
+
+
+def tar_members(archive: tarfile.TarFile):
+    for info in archive:
+        if info.isdir():
+            yield info.name, True, 0, None
+        elif info.isfile():
+            yield info.name, False, 0, lambda info=info: archive.extractfile(info)
+        # Links and special files are never extracted
+
+
+def member_path(destination: Path, name: str) -> Path:
+    parts = PurePosixPath(name.replace("\\", "/")).parts
+    if not parts or parts[0] == "/" or ".." in parts:
+        raise JsonError(f"invalid archive member: {name}")
+    path = destination.joinpath(*(part for part in parts if part != "."))
+    if is_internal_path(path):
+        raise JsonError(f"invalid archive member: {name}")
+    return path
+
+
+def extract_archive(job, archive_path: Path, destination: Path, limit: int, report: Callable[[], None]):
+    """
+    Extract a zip or tar archive into destination one member at a time,
+    enforcing entry count, total size and compression ratio limits while
+    the members are decompressed. Runs as a file job.
+    """
+    try:
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as archive:
+                extract_members(job, zip_members(archive), destination, limit, report)
+        elif tarfile.is_tarfile(archive_path):
+            with tarfile.open(archive_path, "r|*") as archive:
+                extract_members(job, tar_members(archive), destination, limit, report)
+        else:
+            raise JsonError("unsupported archive format")
+    finally:
+        archive_path.unlink(missing_ok=True)
+
+
+def extract_members(job, members, destination: Path, limit: int, report: Callable[[], None]):
+    entries = 0
+    total_size = 0
+    for name, is_dir, compressed_size, opener in members:
+        if job.cancelled:
+            return
+        entries += 1
+        if entries > MAX_ARCHIVE_ENTRIES:
+            raise JsonError(f"archive has more than {MAX_ARCHIVE_ENTRIES} entries")
+
+        path = member_path(destination, name)
+        if is_dir:
+            path.mkdir(parents=True, exist_ok=True)
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        temp_path = staging_path()
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with opener() as src, open(temp_path, "wb") as dst:
+                while chunk := src.read(UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    total_size += len(chunk)
+                    if total_size > limit:
+                        raise JsonError(f"archive exceeds limit of {limit} bytes")
+                    if compressed_size and size > COMPRESSION_RATIO_GRACE and size > compressed_size * MAX_COMPRESSION_RATIO:
+                        raise JsonError(f"archive member is compressed too well: {name}")
+                    digest.update(chunk)
+                    dst.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        store_upload(path, digest.hexdigest())
+        try:
+            thumbnail_file(path)
+        except Exception:
+            pass # A broken image shouldn't stop the extraction
+        job.done += 1
+        report()
+
+
+class ZipStream:
+    """
+    Write-only file object that collects what zipfile writes to it, so the
+    archive can be sent as it is built. zipfile writes data descriptors when
+    the output can't seek, so nothing is ever rewritten.
+    """
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(root: Path) -> Iterator[bytes]:
+    """
+    Pack a directory into a zip archive, yielding the archive in pieces as
+    it is written. Symlinks and internal directories are skipped.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w") as archive:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirpath = Path(dirpath)
+            dirnames[:] = [name for name in dirnames if not is_internal_path(dirpath / name)]
+            if not filenames and not dirnames and dirpath != root:
+                archive.writestr(str(dirpath.relative_to(root)) + "/", b"")
+            for name in filenames:
+                file_path = dirpath / name
+                if file_path.is_symlink():
+                    continue
+                info = zipfile.ZipInfo.from_file(file_path, file_path.relative_to(root))
+                # Don't waste time deflating already compressed media
+                if sniff(file_path).split("/")[0] in STORED_TYPES:
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with open(file_path, "rb") as src, archive.open(info, "w") as dst:
+                    while chunk := src.read(UPLOAD_CHUNK_SIZE):
+                        dst.write(chunk)
+                        yield stream.drain()
+                yield stream.drain()
+    yield stream.drain()
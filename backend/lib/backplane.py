@@ -0,0 +1,242 @@
+import asyncio
+import json
+import os
+import secrets
+import struct
+import traceback
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+WORKERS = int(os.environ.get("WORKERS") or 1)
+# "unix" relays between worker processes through a broker on a local socket
+BACKPLANE = (os.environ.get("BACKPLANE") or ("unix" if WORKERS > 1 else "local")).lower()
+BACKPLANE_SOCKET = os.environ.get("BACKPLANE_SOCKET") or "/tmp/backplane.sock"
+CONNECT_TIMEOUT = 10.0
+RECONNECT_DELAY = 1.0
+# Workers that fall this far behind are dropped by the broker, and reconnect
+MAX_WORKER_BACKLOG = 16 * 1024 * 1024
+
+FRAME_HEADER = struct.Struct("!I")
+
+
+Message = Dict[str, Any]
+Deliver = Callable[[Message], Awaitable[None]]
+
+
+class BackplaneUnavailable(Exception):
+    pass
+
+
+class Sequencer:
+    """
+    Puts pool events in the one order every worker sees them in, numbering
+    them per pool. An event for several pools gets a number in each. Other
+    messages are passed along as they are.
+    """
+
+    def __init__(self):
+        self.epoch = secrets.token_hex(8)
+        self.seqs: Counter[str] = Counter()
+
+    def event(self, message: Message) -> Message:
+        if message["kind"] != "event":
+            return message
+        if "pools" in message:
+            message["seqs"] = [self.next(pool) for pool in message["pools"]]
+        else:
+            message["seq"] = self.next(message["pool"])
+        return message
+
+    def next(self, pool: str) -> int:
+        self.seqs[pool] += 1
+        return self.seqs[pool]
+
+
+class Backplane:
+    """
+    Carries pool events to every worker process serving websockets, including
+    the one they came from. Each worker then hands them to its own
+    connections. Messages of other kinds go to the handler registered for
+    them, on every worker.
+    """
+
+    # Whether messages cross process boundaries
+    shared = False
+
+    def __init__(self):
+        self.epoch = ""
+        # Work that should only happen once across workers is left to the leader
+        self.leader = True
+        self.deliver: Optional[Deliver] = None
+        self.handlers: Dict[str, Deliver] = {}
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    def on(self, kind: str, handler: Deliver):
+        self.handlers[kind] = handler
+
+    async def dispatch(self, message: Message):
+        handler = self.handlers.get(message["kind"])
+        if handler is not None:
+            await handler(message)
+        else:
+            await self.deliver(message)
+
+    async def stop(self):
+        pass
+
+    async def publish(self, message: Message):
+        raise NotImplementedError()
+
+
+class LocalBackplane(Backplane):
+    """
+    Delivers straight back to this process, for running a single worker.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sequencer = Sequencer()
+        self.epoch = self.sequencer.epoch
+
+    async def publish(self, message: Message):
+        await self.dispatch(self.sequencer.event(message))
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Message:
+    header = await reader.readexactly(FRAME_HEADER.size)
+    return json.loads(await reader.readexactly(FRAME_HEADER.unpack(header)[0]))
+
+
+def encode_frame(message: Message) -> bytes:
+    data = json.dumps(message, separators=(",", ":")).encode()
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+class UnixSocketBackplane(Backplane):
+    """
+    Relays through a Broker listening on a Unix socket, for running several
+    workers on one host.
+    """
+
+    shared = True
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.leader = False
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connected = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        self.task = asyncio.create_task(self.run())
+        await asyncio.wait_for(self.connected.wait(), CONNECT_TIMEOUT)
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def run(self):
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                while True:
+                    await self.receive(await read_frame(reader))
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            except Exception:
+                traceback.print_exc()
+            self.connected.clear()
+            self.writer = None
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def receive(self, message: Message):
+        if message["kind"] == "hello":
+            self.epoch = message["epoch"]
+            self.leader = message["leader"]
+            self.connected.set()
+        elif message["kind"] == "leader":
+            self.leader = True
+        else:
+            # A message that fails to deliver mustn't cost the connection to
+            # the broker, and every message after it
+            try:
+                await self.dispatch(message)
+            except Exception:
+                traceback.print_exc()
+
+    async def publish(self, message: Message):
+        try:
+            await asyncio.wait_for(self.connected.wait(), CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise BackplaneUnavailable("not connected to the backplane broker")
+        self.writer.write(encode_frame(message))
+        await self.writer.drain()
+
+
+class Broker:
+    """
+    Sequences messages from the workers connected to a Unix socket and sends
+    each one to all of them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sequencer = Sequencer()
+        # In connection order; the first worker is the leader
+        self.workers: List[asyncio.StreamWriter] = []
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle, self.path)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.workers.append(writer)
+        writer.write(encode_frame({
+            "kind": "hello",
+            "epoch": self.sequencer.epoch,
+            "leader": len(self.workers) == 1,
+        }))
+        try:
+            while True:
+                frame = encode_frame(self.sequencer.event(await read_frame(reader)))
+                for worker in list(self.workers):
+                    worker.write(frame)
+                    # One stalled worker mustn't hold up the rest, or grow
+                    # the broker's buffers without bound
+                    if worker.transport.get_write_buffer_size() > MAX_WORKER_BACKLOG:
+                        self.drop(worker)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.drop(writer)
+
+    def drop(self, writer: asyncio.StreamWriter):
+        if writer not in self.workers:
+            return
+        was_leader = self.workers[0] is writer
+        self.workers.remove(writer)
+        writer.close()
+        if was_leader and self.workers:
+            self.workers[0].write(encode_frame({"kind": "leader"}))
+
+
+def create_backplane() -> Backplane:
+    if BACKPLANE == "local":
+        return LocalBackplane()
+    elif BACKPLANE == "unix":
+        return UnixSocketBackplane(BACKPLANE_SOCKET)
+    else:
+        raise ValueError(f"unknown backplane: {BACKPLANE}")
+
+
+backplane = create_backplane()
@@ -0,0 +1,117 @@
+import os
+import secrets
+from pathlib import Path
+
+from ..models.database_models import FILES_ROOT
+
+
+# When enabled, uploaded files are stored once per unique content under
+# BLOBS_DIR, and every user path with those contents is a hardlink to the
+# blob. The blob's link count doubles as its reference count.
+DEDUPLICATE_FILES = os.environ.get("DEDUPLICATE_FILES", "").lower() in ("1", "true", "yes")
+BLOBS_DIR = FILES_ROOT / ".blobs"
+# Files being written are staged here, on the same filesystem as their
+# destination so they can be renamed into place, but out of sight of
+# listings and the watcher
+UPLOADS_DIR = FILES_ROOT / ".uploads"
+
+
+def blob_path(content_hash: str) -> Path:
+    return BLOBS_DIR / content_hash[:2] / content_hash
+
+
+def is_blob_path(path: Path) -> bool:
+    return path == BLOBS_DIR or BLOBS_DIR in path.parents
+
+
+def staging_path(suffix: str = ".upload") -> Path:
+    """
+    Get a unique path to write a file to before renaming it into place.
+    """
+    UPLOADS_DIR.mkdir(exist_ok=True)
+    return UPLOADS_DIR / f"{secrets.token_hex(8)}{suffix}"
+
+
+def store_blob(path: Path, content_hash: str):
+    """
+    Move the contents of path into the blob store, leaving path as a
+    hardlink to the blob. If the store already has a blob with the same
+    contents, path is relinked to it and its own copy is freed.
+    """
+    blob = blob_path(content_hash)
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(path, blob)
+    except FileExistsError:
+        temp_path = staging_path(".link")
+        try:
+            os.link(blob, temp_path)
+            os.replace(temp_path, path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+
+def release_blob(content_hash: str) -> int:
+    """
+    Delete the blob for the given content hash if no user paths link to it
+    anymore, returning the number of bytes freed.
+    """
+    blob = blob_path(content_hash)
+    try:
+        stat = blob.stat()
+    except FileNotFoundError:
+        return 0
+    if stat.st_nlink > 1:
+        return 0
+    blob.unlink(missing_ok=True)
+    return stat.st_size
+
+
+def iter_blobs():
+    if not BLOBS_DIR.is_dir():
+        return
+    with os.scandir(BLOBS_DIR) as prefixes:
+        for prefix in prefixes:
+            if not prefix.is_dir(follow_symlinks=False):
+                continue
+            with os.scandir(prefix.path) as blobs:
+                for blob in blobs:
+                    yield blob
+
+
+def blob_stats() -> dict[str, int]:
+    """
+    Summarize the blob store. Referenced bytes are what the user paths would
+    take up without deduplication; reclaimed bytes are what deduplication
+    saves.
+    """
+    blobs = 0
+    stored_bytes = 0
+    referenced_bytes = 0
+    orphaned_bytes = 0
+    for blob in iter_blobs():
+        stat = blob.stat(follow_symlinks=False)
+        blobs += 1
+        stored_bytes += stat.st_size
+        references = stat.st_nlink - 1
+        referenced_bytes += stat.st_size * references
+        if references == 0:
+            orphaned_bytes += stat.st_size
+    return {
+        "blobs": blobs,
+        "stored_bytes": stored_bytes,
+        "referenced_bytes": referenced_bytes,
+        "reclaimed_bytes": referenced_bytes - stored_bytes + orphaned_bytes,
+        "orphaned_bytes": orphaned_bytes,
+    }
+
+
+def collect_blobs() -> int:
+    """
+    Delete every blob that no user path links to, returning the number of
+    bytes freed.
+    """
+    freed = 0
+    for blob in iter_blobs():
+        freed += release_blob(blob.name)
+    return freed
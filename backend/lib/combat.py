@@ -0,0 +1,342 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from . import database
+from .backplane import backplane
+from .errors import JsonError
+from ..models.database_models import Combat, Combatant, CombatEvent
+
+
+WRITE_BEHIND_DELAY = 0.05
+# Failed writes are retried with a growing delay, up to this long
+MAX_RETRY_DELAY = 5.0
+# Combats without unwritten changes are dropped from memory once unused for this long
+IDLE_TIMEOUT = 600.0
+EVICT_INTERVAL = 60.0
+EVENT_TAIL_SIZE = 100
+TURN_EVENTS = {"end-turn", "reverse-turn"}
+DUPLICATE_KEY = 11000
+
+
+@dataclass
+class ActiveCombat:
+    combat: Combat
+    persisted_version: int = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    dirty: bool = False
+    flush_task: Optional[asyncio.Task] = None
+    events: Deque[CombatEvent] = field(default_factory=lambda: deque(maxlen=EVENT_TAIL_SIZE))
+    pending_events: List[CombatEvent] = field(default_factory=list)
+    # Changes dropped because the combat was changed elsewhere first
+    lost_events: Deque[CombatEvent] = field(default_factory=lambda: deque(maxlen=EVENT_TAIL_SIZE))
+    last_used: float = field(default_factory=time.monotonic)
+
+    @property
+    def order(self) -> List[str]:
+        return [combatant.id for combatant in self.combat.combatants]
+
+
+class CombatEngine:
+    """
+    Holds combats that are in use in memory, so turn operations don't have to
+    read, validate and write back the whole document. Changes are written
+    behind to mongo, guarded by the combat's version. Writes that fail are
+    retried, and changes that lose to a change made elsewhere are replaced
+    by the stored state, which clients are told to reload.
+
+    Every change is also appended to the combat's event log, sequenced by the
+    version it produced, so clients can catch up on missed changes and turn
+    changes can be undone.
+
+    When other worker processes can change the same combats, a combat is
+    reloaded whenever its lock is taken without changes of its own waiting to
+    be written, and changes are written before they are published.
+    """
+
+    def __init__(self, shared: bool = False):
+        self.active: Dict[str, ActiveCombat] = {}
+        self.shared = shared
+        self.last_eviction = time.monotonic()
+
+    def get(self, combat_id: str) -> Optional[ActiveCombat]:
+        now = time.monotonic()
+        if now - self.last_eviction >= EVICT_INTERVAL:
+            self.evict_idle(now)
+        active = self.active.get(combat_id, None)
+        if active is None:
+            combat = database.combats.find_one(combat_id)
+            if combat is None:
+                return None
+            active = self.active.setdefault(combat.id, ActiveCombat(combat, combat.version))
+            if not active.events:
+                active.events.extend(self.recent_events(combat.id))
+        active.last_used = now
+        return active
+
+    @asynccontextmanager
+    async def locked(self, active: ActiveCombat) -> AsyncIterator[ActiveCombat]:
+        """
+        Hold a combat's lock, with its state brought up to date first if
+        other workers may have changed it.
+        """
+        async with active.lock:
+            if self.shared and not active.dirty and active.flush_task is None:
+                if not await self.reload(active):
+                    raise JsonError("invalid combat id")
+            yield active
+
+    def evict_idle(self, now: float):
+        self.last_eviction = now
+        for combat_id, active in list(self.active.items()):
+            if (
+                now - active.last_used >= IDLE_TIMEOUT
+                and not active.dirty
+                and active.flush_task is None
+                and not active.lock.locked()
+            ):
+                del self.active[combat_id]
+
+    @staticmethod
+    def recent_events(combat_id: str) -> List[CombatEvent]:
+        recent = database.combat_events.find({"combat_id": combat_id}, sort=[("seq", -1)], limit=EVENT_TAIL_SIZE)
+        return list(reversed(recent))
+
+    async def reload(self, active: ActiveCombat, replace_events: bool = False) -> bool:
+        """
+        Replace the in-memory state of a combat with the stored one. Returns
+        False, and forgets the combat, if it has been deleted.
+        """
+        combat = await asyncio.to_thread(database.combats.find_one, active.combat.id)
+        if combat is None:
+            if self.active.get(active.combat.id) is active:
+                del self.active[active.combat.id]
+            return False
+        if replace_events or combat.version != active.combat.version:
+            active.events.clear()
+            active.events.extend(await asyncio.to_thread(self.recent_events, combat.id))
+        active.combat = combat
+        active.persisted_version = combat.version
+        return True
+
+    def cached(self, combat: Combat) -> Combat:
+        """
+        Get the in-memory state of a combat loaded from the database, which
+        may be ahead of what has been written so far.
+        """
+        active = self.active.get(combat.id, None)
+        if active is None or (self.shared and not active.dirty and active.flush_task is None):
+            return combat
+        return active.combat
+
+    def changed(self, active: ActiveCombat, type: str, **data) -> CombatEvent:
+        active.combat.version += 1
+        event = CombatEvent(combat_id=active.combat.id, seq=active.combat.version, type=type, data=data)
+        active.events.append(event)
+        active.pending_events.append(event)
+        active.dirty = True
+        if active.flush_task is None:
+            active.flush_task = asyncio.create_task(self.write_behind(active))
+        return event
+
+    async def write_behind(self, active: ActiveCombat):
+        try:
+            # Let bursts of changes coalesce into one write
+            await asyncio.sleep(0 if self.shared else WRITE_BEHIND_DELAY)
+            delay = WRITE_BEHIND_DELAY
+            while active.dirty and self.active.get(active.combat.id) is active:
+                if await self.flush(active):
+                    delay = WRITE_BEHIND_DELAY
+                else:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY)
+        finally:
+            active.flush_task = None
+
+    async def flush(self, active: ActiveCombat) -> bool:
+        """
+        Write a combat's changes and their events. Returns False if the
+        write failed and should be tried again.
+        """
+        active.dirty = False
+        combat = active.combat
+        version = combat.version
+        update = {"$set": {
+            "combatants": [combatant.model_dump() for combatant in combat.combatants],
+            "version": version,
+        }}
+        events = active.pending_events
+        active.pending_events = []
+        version_filter = active.persisted_version if active.persisted_version else {"$in": [0, None]}
+        try:
+            # Only the events are left if an earlier attempt wrote the combat
+            if version != active.persisted_version:
+                result = await asyncio.to_thread(
+                    database.combats.find_one_and_update,
+                    {"id": combat.id, "version": version_filter},
+                    update,
+                )
+                if result is None:
+                    await self.resync(active, events)
+                    return True
+                active.persisted_version = version
+            if events:
+                await asyncio.to_thread(self.log_events, events)
+        except Exception:
+            # Keep the changes, along with any made in the meantime
+            traceback.print_exc()
+            active.pending_events = events + active.pending_events
+            active.dirty = True
+            return False
+        return True
+
+    @staticmethod
+    def log_events(events: List[CombatEvent]):
+        try:
+            database.combat_events.insert_many([event.document() for event in events], ordered=False)
+        except BulkWriteError as exc:
+            # Events logged by an earlier attempt are already there
+            if any(error["code"] != DUPLICATE_KEY for error in exc.details["writeErrors"]):
+                raise
+
+    async def resync(self, active: ActiveCombat, events: List[CombatEvent]):
+        """
+        Take the stored state of a combat whose changes lost to a change made
+        elsewhere. Its unwritten changes are dropped, and clients that were
+        already sent them are told to reload.
+        """
+        active.lost_events.extend(events + active.pending_events)
+        active.pending_events = []
+        active.dirty = False
+        if await self.reload(active, replace_events=True) and not self.shared:
+            await active.combat.pool.broadcast({"type": "reload", "version": active.combat.version})
+
+    async def settle(self, active: ActiveCombat):
+        """
+        Wait for any pending write of the combat to reach the database.
+        """
+        if active.flush_task is not None:
+            await active.flush_task
+
+    async def publish(self, active: ActiveCombat, event: CombatEvent):
+        """
+        Broadcast a change to the combat's subscribers.
+        """
+        if self.shared:
+            await self.settle(active)
+            if any(lost is event for lost in active.lost_events) or self.active.get(active.combat.id) is not active:
+                raise JsonError("combat was changed by someone else, try again")
+        await active.combat.pool.broadcast(event.broadcast_dict())
+
+    def end_turn(self, active: ActiveCombat) -> Tuple[Combatant, CombatEvent]:
+        combatants = active.combat.combatants
+        combatant = combatants.pop(0)
+        combatants.append(combatant)
+        return combatant, self.changed(active, "end-turn", id=combatant.id)
+
+    def reverse_turn(self, active: ActiveCombat) -> Tuple[Combatant, CombatEvent]:
+        combatants = active.combat.combatants
+        combatant = combatants.pop()
+        combatants.insert(0, combatant)
+        return combatant, self.changed(active, "reverse-turn", id=combatant.id)
+
+    def undo_turns(self, active: ActiveCombat, count: int) -> Optional[CombatEvent]:
+        """
+        Undo up to count of the most recent turn changes, stopping at the
+        first other kind of change. Returns None if there is nothing to undo.
+        """
+        undone = set()
+        undoing = []
+        for event in reversed(active.events):
+            if len(undoing) >= count:
+                break
+            if event.type == "undo":
+                undone.update(event.data["undoes"])
+            elif event.seq in undone:
+                continue
+            elif event.type in TURN_EVENTS:
+                undoing.append(event)
+            else:
+                break
+        if not undoing:
+            return None
+
+        # Only rotations happened since, so the inverse rotations are exact
+        combatants = active.combat.combatants
+        for event in undoing:
+            if event.type == "end-turn":
+                combatants.insert(0, combatants.pop())
+            else:
+                combatants.append(combatants.pop(0))
+        return self.changed(active, "undo", undoes=[event.seq for event in undoing], order=active.order)
+
+    def set_order(self, active: ActiveCombat, combatants: List[Combatant], type: str = "order", **data) -> CombatEvent:
+        active.combat.combatants = combatants
+        return self.changed(active, type, order=active.order, **data)
+
+    def add_combatant(self, active: ActiveCombat, combatant: Combatant) -> CombatEvent:
+        active.combat.combatants.append(combatant)
+        return self.changed(active, "update", changes={
+            "$push": {"combatants": combatant.model_dump()},
+            "$inc": {"version": 1},
+        })
+
+    def clear(self, active: ActiveCombat) -> CombatEvent:
+        active.combat.combatants = []
+        return self.changed(active, "update", changes={
+            "$set": {"combatants": []},
+            "$inc": {"version": 1},
+        })
+
+    async def update(self, active: ActiveCombat, changes: dict) -> Optional[CombatEvent]:
+        """
+        Apply a raw mongo update to a combat, once pending writes are settled,
+        and take the result as the new in-memory state.
+        """
+        await self.settle(active)
+        combat = await asyncio.to_thread(database.combats.find_one_and_update, active.combat.id, changes)
+        if combat is None:
+            self.active.pop(active.combat.id, None)
+            return None
+        active.combat = combat
+        active.persisted_version = combat.version
+        event = CombatEvent(combat_id=combat.id, seq=combat.version, type="update", data={"changes": changes})
+        try:
+            await asyncio.to_thread(database.combat_events.insert_one, event.document())
+        except DuplicateKeyError:
+            # Something else logged a change at this version, so the log no
+            # longer describes the combat. Subscribers reload it instead.
+            traceback.print_exc()
+            await self.reload(active, replace_events=True)
+            return CombatEvent(combat_id=combat.id, seq=combat.version, type="reload")
+        active.events.append(event)
+        return event
+
+    def events_since(self, active: ActiveCombat, seq: int) -> Optional[List[CombatEvent]]:
+        """
+        Get the events after the given sequence number, or None if some of
+        them are no longer available and the client should reload the combat.
+        """
+        version = active.combat.version
+        if seq >= version:
+            return []
+        if active.events and active.events[0].seq <= seq + 1:
+            events = [event for event in active.events if event.seq > seq]
+        else:
+            events = database.combat_events.find(
+                {"combat_id": active.combat.id, "seq": {"$gt": seq, "$lte": active.persisted_version}},
+                sort=[("seq", 1)],
+            )
+            events.extend(event for event in active.events if event.seq > active.persisted_version)
+        # Changes from before the log, or lost to a conflict, leave gaps
+        if [event.seq for event in events] != list(range(seq + 1, version + 1)):
+            return None
+        return events
+
+
+combat_engine = CombatEngine(shared=backplane.shared)
@@ -1,9 +1,11 @@
 import pymongo
 from bson import ObjectId
+from contextlib import contextmanager
 from pydantic import BaseModel, ValidationError
 from pymongo import ReturnDocument
+from pymongo.client_session import ClientSession
 from pymongo.collection import Collection
-from typing import Generic, List, Type, TypeVar, Union
+from typing import Generic, Iterator, List, Optional, Type, TypeVar, Union
 
 from ..models import database_models as models
 
@@ -51,12 +53,14 @@ class DocumentCollection(Generic[M]):
     def pre_process_filter(self, filter: dict):
         return _prepare_filter(filter)
 
-    def post_process_result(self, document: dict) -> M:
+    def post_process_result(self, document: dict, model: Type[BaseModel] = None) -> M:
         if document is None:
             return None
+        if model is None:
+            model = self.model
 
         try:
-            return self.model.model_validate(_jsonify_oid(document))
+            return model.model_validate(_jsonify_oid(document))
         except ValidationError as exc:
             for error in exc.errors():
                 location = list(error['loc'])
@@ -75,7 +79,7 @@ class DocumentCollection(Generic[M]):
                 else:
                     del cursor[terminal]
 
-            return self.model.model_validate(_jsonify_oid(document))
+            return model.model_validate(_jsonify_oid(document))
 
 
     def create_index(self, *args, **kwargs):
@@ -86,8 +90,15 @@ class DocumentCollection(Generic[M]):
             return None
         return self.post_process_result(self.collection.find_one(self.pre_process_filter(filter)))
 
-    def find(self, filter: dict = None, *args, **kwargs) -> List[M]:
-        return [self.post_process_result(document) for document in self.collection.find(self.pre_process_filter(filter), *args, **kwargs)]
+    def find(self, filter: dict = None, *args, projection: dict = None, model: Type[BaseModel] = None, **kwargs) -> List[M]:
+        """
+        Find all matching documents. A projection limits the fields fetched,
+        in which case a model describing just those fields should be given.
+        """
+        return [
+            self.post_process_result(document, model)
+            for document in self.collection.find(self.pre_process_filter(filter), projection, *args, **kwargs)
+        ]
 
     def delete_one(self, filter: dict = None, *args, **kwargs):
         return self.collection.delete_one(self.pre_process_filter(filter), *args, **kwargs).deleted_count != 0
@@ -114,6 +125,9 @@ class DocumentCollection(Generic[M]):
     def upsert(self, filter: dict, update: dict, *args, **kwargs):
         return _jsonify_oid(self.collection.update_one(self.pre_process_filter(filter), update, *args, **kwargs, upsert=True).upserted_id)
 
+    def aggregate(self, pipeline: List[dict], *args, **kwargs) -> List[dict]:
+        return list(self.collection.aggregate(pipeline, *args, **kwargs))
+
     def insert_one(self, *args, **kwargs) -> str:
         return _jsonify_oid(self.collection.insert_one(*args, **kwargs).inserted_id)
 
@@ -121,6 +135,54 @@ class DocumentCollection(Generic[M]):
         return [_jsonify_oid(id) for id in self.collection.insert_many(*args, **kwargs).inserted_ids]
 
 
+def ensure_folder_ancestors(folders: DocumentCollection[models.Folder]):
+    """
+    Fill in the materialized ancestor ids of folders created before folders
+    tracked them.
+    """
+    if folders.collection.find_one({"ancestors": {"$exists": False}}) is None:
+        return
+    parents = {
+        _jsonify_oid(document["_id"]): document.get("parent_id")
+        for document in folders.collection.find({}, {"parent_id": True})
+    }
+    updates = []
+    for folder_id in parents:
+        ancestors = []
+        parent_id = parents[folder_id]
+        while parent_id is not None and parent_id in parents and parent_id not in ancestors:
+            ancestors.insert(0, parent_id)
+            parent_id = parents[parent_id]
+        updates.append(pymongo.UpdateOne({"_id": ObjectId(folder_id)}, {"$set": {"ancestors": ancestors}}))
+    folders.collection.bulk_write(updates)
+
+
+def supports_transactions() -> bool:
+    global _supports_transactions
+    if _supports_transactions is None:
+        hello = db.command("hello")
+        _supports_transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return _supports_transactions
+
+
+_supports_transactions: Optional[bool] = None
+
+
+@contextmanager
+def transaction() -> Iterator[Optional[ClientSession]]:
+    """
+    Yield a session with a transaction started, to pass to every operation
+    that should commit together. Standalone servers don't support
+    transactions, in which case None is yielded and operations run as usual.
+    """
+    if not supports_transactions():
+        yield None
+        return
+    with client.start_session() as session:
+        with session.start_transaction():
+            yield session
+
+
 # Mongo Client
 client = pymongo.MongoClient("mongodb://nonsense_db:27017")
 db = client.nonsense_db
@@ -135,12 +197,29 @@ notes.create_index("folder_id")
 items = DocumentCollection(db.items, models.Item)
 users = DocumentCollection(db.users, models.User)
 combats = DocumentCollection(db.combats, models.Combat)
+combat_events = DocumentCollection(db.combat_events, models.CombatEvent)
+combat_events.create_index([("combat_id", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)], unique=True)
 maps = DocumentCollection(db.maps, models.Map)
 messages = DocumentCollection(db.messages, models.Message)
 ability_folders = DocumentCollection(db.ability_folders, models.Folder)
 character_folders = DocumentCollection(db.character_folders, models.Folder)
 note_folders = DocumentCollection(db.note_folders, models.Folder)
+for folder_collection in (ability_folders, character_folders, note_folders):
+    folder_collection.create_index("parent_id")
+    folder_collection.create_index("ancestors")
+    ensure_folder_ancestors(folder_collection)
+for permissioned_collection in (abilities, characters, notes, maps, ability_folders, character_folders, note_folders):
+    permissioned_collection.create_index("permissions.$**")
+files = DocumentCollection(db.files, models.FileRecord)
+files.create_index("path", unique=True)
+files.create_index("hash")
+file_jobs = DocumentCollection(db.file_jobs, models.FileJobRecord)
+# Finished jobs stay listed for a day
+file_jobs.create_index("finished", expireAfterSeconds=86400)
 
 sessions = DocumentCollection(db.sessions, models.Session)
 sessions.create_index("auth_token")
 sessions.create_index("last_auth_date", expireAfterSeconds=2592000)
+presence = DocumentCollection(db.presence, models.Lease)
+presence.create_index("user_id")
+presence.create_index("expires", expireAfterSeconds=0)
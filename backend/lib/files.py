@@ -1,14 +1,33 @@
+import aiofiles
+import aiofiles.os
 import hashlib
+import heapq
 import os
+import re
+import traceback
+from dataclasses import dataclass
+from operator import itemgetter
 from pathlib import Path
+from stat import S_ISDIR, S_ISREG
+from typing import Iterable, Optional
+from fastapi import BackgroundTasks, UploadFile
 from wand.image import Image
 from wand.color import Color
 
+from . import database
+from .blobs import DEDUPLICATE_FILES, UPLOADS_DIR, is_blob_path, staging_path, store_blob, release_blob
 from .errors import JsonError
-from ..models.database_models import User
+from ..models.database_models import FILES_ROOT, FileRecord, User
 
 
 THUMBNAILS_DIR = Path("/thumbnails")
+HASH_CHUNK_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 256 * 1024
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE") or 20 * 1024 * 1024)
+USER_QUOTA = int(os.environ.get("USER_QUOTA") or 0)
+# Internal nginx location to hand file downloads back to once the API has
+# checked them, e.g. "/internal/files/". Files are sent by the API if unset
+FILES_ACCEL_REDIRECT = os.environ.get("FILES_ACCEL_REDIRECT") or ""
 
 
 file_extensions = {
@@ -113,6 +132,39 @@ file_signatures = (
 )
 
 
+def index_signatures(signatures) -> dict[Optional[int], list[tuple[list[tuple[int, bytes]], str]]]:
+    """
+    Group file signatures by the first byte they require, so a sample only
+    has to be checked against signatures that can possibly match it.
+    Signatures without a part at offset 0 are grouped under None.
+    """
+    index = {}
+    for signature, result in signatures:
+        if isinstance(signature, bytes):
+            signature = [(0, signature)]
+        first_byte = None
+        for offset, part in signature:
+            if offset == 0:
+                first_byte = part[0]
+        index.setdefault(first_byte, []).append((signature, result))
+    return index
+
+
+signature_index = index_signatures(file_signatures)
+
+
+SNIFF_CACHE_SIZE = 65536
+sniff_cache: dict[tuple[int, int, int, int], str] = {}
+
+
+def is_internal_path(path: Path) -> bool:
+    """
+    Whether a path is in the blob store or the upload staging directory,
+    which users never see.
+    """
+    return is_blob_path(path) or path == UPLOADS_DIR or UPLOADS_DIR in path.parents
+
+
 def sample(path: Path) -> bytes:
     fd = os.open(str(path), os.O_RDONLY)
     try:
@@ -121,33 +173,15 @@ def sample(path: Path) -> bytes:
         os.close(fd)
 
 
-def sniff(path: Path):
-    if path.is_symlink():
-        path = path.resolve()
-    # Check for directory
-    if path.is_dir():
-        return "directory"
-    # Make sure the file exists
-    if not path.is_file():
-        raise FileNotFoundError(str(path))
-    # Check for known extensions
-    if result := file_extensions.get(path.suffix, None):
-        return result
-    # Get a sample
-    data = sample(path)
+def sniff_sample(data: bytes) -> str:
     # Check the sample against known magic bytes
-    for signature, result in file_signatures:
-        if isinstance(signature, bytes):
-            if data.startswith(signature):
-                return result
+    candidates = signature_index.get(data[0], []) if data else []
+    for signature, result in candidates + signature_index.get(None, []):
+        for offset, part in signature:
+            if part != data[offset : offset + len(part)]:
+                break
         else:
-            match = True
-            for offset, part in signature:
-                if part != data[offset : offset + len(part)]:
-                    match = False
-                    break
-            if match:
-                return result
+            return result
     # Check if the sample contains non-utf-8 characters
     try:
         text = data.decode("utf-8")
@@ -160,26 +194,462 @@ def sniff(path: Path):
         return "binary"
 
 
-def generate_thumbnail(image_path: Path, force: bool = False, svg: bool = False):
-    thumbnail_path = THUMBNAILS_DIR / (hashlib.sha256(bytes(image_path)).hexdigest() + ".png")
-    if not force and thumbnail_path.exists():
-        return
+def sniff(path: Path, stat: os.stat_result = None, is_symlink: Optional[bool] = None) -> str:
+    # Stat the file, following symlinks, unless the caller already has
+    if stat is None:
+        stat = path.stat()
+    # Check for directory
+    if S_ISDIR(stat.st_mode):
+        return "directory"
+    # Make sure the file exists
+    if not S_ISREG(stat.st_mode):
+        raise FileNotFoundError(str(path))
+    # Check for an earlier result for the same version of the same file
+    key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    result = sniff_cache.get(key)
+    if result is not None:
+        return result
+    # Symlinks are typed by their target, callers listing a directory
+    # already know which entries are symlinks
+    if is_symlink is None:
+        is_symlink = path.is_symlink()
+    if is_symlink:
+        path = path.resolve()
+    # Check for known extensions, then the contents
+    result = file_extensions.get(path.suffix, None) or sniff_sample(sample(path))
+    if len(sniff_cache) >= SNIFF_CACHE_SIZE:
+        del sniff_cache[next(iter(sniff_cache))]
+    sniff_cache[key] = result
+    return result
+
+
+@dataclass
+class ListedFile:
+    name: str
+    path: str
+    stat: os.stat_result
+    is_symlink: bool = False
+    file_type: Optional[str] = None
+
+    @property
+    def is_dir(self) -> bool:
+        return S_ISDIR(self.stat.st_mode)
+
+    @property
+    def type(self) -> str:
+        if self.file_type is None:
+            self.file_type = sniff(Path(self.path), self.stat, self.is_symlink)
+        return self.file_type
+
+    def changed_from(self, other: "ListedFile") -> bool:
+        return (
+            self.stat.st_ino != other.stat.st_ino
+            or self.stat.st_mtime_ns != other.stat.st_mtime_ns
+            or self.stat.st_size != other.stat.st_size
+        )
+
+
+def scan_directory(path: Path) -> list[ListedFile]:
+    """
+    List a directory with a single os.scandir() stat pass. Broken symlinks
+    and internal directories are left out, and file types are sniffed on demand.
+    """
+    results = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if is_internal_path(Path(entry.path)):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            results.append(ListedFile(entry.name, entry.path, stat, entry.is_symlink()))
+    return results
+
+
+def disk_usage(root: Path) -> int:
+    """
+    Get the total size of the indexed files under the given root.
+    """
+    results = database.files.aggregate([
+        {"$match": {"path": {"$regex": "^" + re.escape(str(root) + "/")}}},
+        {"$group": {"_id": None, "size": {"$sum": "$size"}}},
+    ])
+    return results[0]["size"] if results else 0
+
+
+def upload_limit(requester: User, destination: Path, limit: int = MAX_UPLOAD_SIZE) -> int:
+    """
+    Get the largest upload the requester can write to the destination,
+    taking the requester's quota into account for non-GMs.
+    """
+    if USER_QUOTA and not requester.is_gm:
+        remaining = USER_QUOTA - disk_usage(requester.file_root)
+        # Overwriting a file frees up its space
+        if destination.is_file():
+            remaining += destination.stat().st_size
+        if remaining <= 0:
+            raise JsonError("file quota exceeded")
+        limit = min(limit, remaining)
+    return limit
+
+
+async def save_upload(upload: UploadFile, destination: Path, limit: int) -> str:
+    """
+    Stream an upload into a staging file and rename it into place once
+    complete, enforcing the size limit as the upload is read. Returns the
+    sha256 of the contents.
+    """
+    temp_path = staging_path()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, "wb") as fp:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > limit:
+                    raise JsonError(f"upload exceeds limit of {limit} bytes")
+                digest.update(chunk)
+                await fp.write(chunk)
+        await aiofiles.os.replace(temp_path, destination)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return digest.hexdigest()
+
+
+# The types of each part of the keys sort_key() returns
+SORT_KEY_TYPES = {
+    "name": (str,),
+    "type": (str, str),
+    "mtime": ((int, float), str),
+    "size": (int, str),
+}
+
+
+def sort_key(entry: ListedFile, sort: str) -> tuple:
+    if sort == "name":
+        return (entry.name,)
+    elif sort == "type":
+        return (entry.type, entry.name)
+    elif sort == "mtime":
+        return (entry.stat.st_mtime, entry.name)
+    elif sort == "size":
+        return (entry.stat.st_size, entry.name)
+    else:
+        raise JsonError("invalid sort")
+
+
+def list_directory(
+    entries: Iterable[ListedFile],
+    sort: str = "type",
+    reverse: bool = False,
+    limit: Optional[int] = None,
+    after: Optional[tuple] = None,
+) -> tuple[list[tuple[tuple, ListedFile]], Optional[tuple]]:
+    """
+    Return one page of (sort key, entry) pairs from a directory listing,
+    starting after the given sort key, along with the sort key to resume from
+    if there are more entries. Only the entries on the page are kept when a
+    limit is given, and entries are only sniffed if sorting by type.
+    """
+    keyed = ((sort_key(entry, sort), entry) for entry in entries)
+    if after is not None:
+        if reverse:
+            keyed = (item for item in keyed if item[0] < after)
+        else:
+            keyed = (item for item in keyed if item[0] > after)
+    if limit is None:
+        return sorted(keyed, key=itemgetter(0), reverse=reverse), None
+    # Fetch one extra entry to find out if there is another page
+    if reverse:
+        page = heapq.nlargest(limit + 1, keyed, key=itemgetter(0))
+    else:
+        page = heapq.nsmallest(limit + 1, keyed, key=itemgetter(0))
+    if len(page) > limit:
+        page = page[:limit]
+        return page, page[-1][0]
+    return page, None
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while chunk := fp.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    image_params = {"filename": image_path}
 
-    if svg:
-        image_params["background"] = Color('transparent')
+@dataclass(frozen=True)
+class ThumbnailProfile:
+    size: int
+    format: str
+
+    def name(self, content_hash: str) -> str:
+        return f"{content_hash}_{self.size}.{self.format}"
+
+
+def parse_thumbnail_profiles(spec: str) -> tuple[ThumbnailProfile, ...]:
+    """
+    Parse a comma separated list of SIZE:FORMAT thumbnail profiles,
+    e.g. "64:webp,128:png,512:webp".
+    """
+    profiles = []
+    for item in spec.split(","):
+        size, _, format = item.strip().partition(":")
+        profiles.append(ThumbnailProfile(int(size), format.lower() or "png"))
+    profiles.sort(key=lambda profile: profile.size)
+    return tuple(profiles)
+
+
+THUMBNAIL_PROFILES = parse_thumbnail_profiles(os.environ.get("THUMBNAIL_PROFILES") or "64:webp,128:png,512:webp")
+
+
+def select_thumbnail_profile(size: int) -> ThumbnailProfile:
+    """
+    Get the smallest thumbnail profile at least as large as the given size.
+    """
+    for profile in THUMBNAIL_PROFILES:
+        if profile.size >= size:
+            return profile
+    return THUMBNAIL_PROFILES[-1]
+
+
+def release_thumbnail(content_hash: str):
+    """
+    Delete the thumbnails for the given content hash, unless some other
+    indexed file still has the same contents. Variants of profiles that
+    have since been removed from THUMBNAIL_PROFILES are deleted too.
+    """
+    if database.files.find_one({"hash": content_hash}) is None:
+        for path in THUMBNAILS_DIR.glob(f"{content_hash}_*"):
+            path.unlink(missing_ok=True)
+
+
+def record_file(path: Path, content_hash: str, stat: os.stat_result = None):
+    """
+    Store the content hash of a file in the file index, along with the
+    mtime and size used to detect when it is overwritten.
+    """
+    if stat is None:
+        stat = path.stat()
+    previous: FileRecord = database.files.find_one({"path": str(path)})
+    changes = {
+        "hash": content_hash,
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+    }
+    if previous is None or previous.hash != content_hash:
+        changes["thumbnails"] = []
+    database.files.upsert({"path": str(path)}, {"$set": changes})
+    if previous is not None and previous.hash != content_hash:
+        release_thumbnail(previous.hash)
+        release_blob(previous.hash)
+
+
+def store_upload(path: Path, content_hash: str):
+    """
+    Add a newly uploaded file to the blob store, if deduplication is
+    enabled, and to the file index.
+    """
+    if DEDUPLICATE_FILES:
+        store_blob(path, content_hash)
+    record_file(path, content_hash)
+
+
+def find_file_record(path: Path, stat: os.stat_result) -> Optional[FileRecord]:
+    """
+    Get the file index record for a file, or None if it is not indexed yet
+    or has changed on disk since it was indexed.
+    """
+    record: FileRecord = database.files.find_one({"path": str(path)})
+    if record is not None and record.mtime == stat.st_mtime and record.size == stat.st_size:
+        return record
+    return None
+
+
+def get_file_record(path: Path, stat: os.stat_result = None) -> FileRecord:
+    """
+    Get the file index record for a file, rehashing the file if it is not
+    indexed yet or has changed on disk since it was indexed.
+    """
+    if stat is None:
+        stat = path.stat()
+    if (record := find_file_record(path, stat)) is not None:
+        return record
+    record_file(path, hash_file(path), stat)
+    return database.files.find_one({"path": str(path)})
+
+
+def get_content_hash(path: Path, stat: os.stat_result = None) -> str:
+    return get_file_record(path, stat).hash
+
+
+def move_records(src: Path, dst: Path):
+    """
+    Update the file index after src is renamed to dst. Content hashes don't
+    change on a rename, so existing thumbnails remain valid.
+    """
+    delete_records(dst)
+    database.files.update_many({"path": str(src)}, {"$set": {"path": str(dst)}})
+    prefix = str(src) + "/"
+    database.files.update_many(
+        {"path": {"$regex": "^" + re.escape(prefix)}},
+        [{"$set": {"path": {"$concat": [
+            str(dst) + "/",
+            {"$substrCP": ["$path", len(prefix), {"$strLenCP": "$path"}]},
+        ]}}}],
+    )
+
+
+def release_records(filter: dict) -> int:
+    """
+    Remove the matching records from the file index, deleting any thumbnails
+    and blobs that are no longer referenced. Returns the number of blob
+    bytes freed.
+    """
+    records: list[FileRecord] = database.files.find(filter)
+    if not records:
+        return 0
+    database.files.delete_many({"path": {"$in": [record.path for record in records]}})
+    freed = 0
+    for content_hash in {record.hash for record in records}:
+        release_thumbnail(content_hash)
+        freed += release_blob(content_hash)
+    return freed
+
+
+def delete_records(path: Path) -> int:
+    """
+    Remove a file or directory from the file index.
+    """
+    return release_records({"$or": [
+        {"path": str(path)},
+        {"path": {"$regex": "^" + re.escape(str(path) + "/")}},
+    ]})
+
+
+def delete_file_records(paths: list[Path]) -> int:
+    """
+    Remove a batch of deleted files from the file index.
+    """
+    return release_records({"path": {"$in": [str(path) for path in paths]}})
+
+
+def generate_thumbnails(image_path: Path, force: bool = False, svg: bool = False, stat: os.stat_result = None) -> list[tuple[ThumbnailProfile, str]]:
+    """
+    Generate any missing thumbnail variants for an image, decoding the
+    source image at most once, and return (profile, name) pairs for all of
+    the variants from smallest to largest.
+    """
+    record = get_file_record(image_path, stat)
+    variants = [(profile, profile.name(record.hash)) for profile in THUMBNAIL_PROFILES]
+
+    missing = []
+    for profile, name in variants:
+        if force or (name not in record.thumbnails and not (THUMBNAILS_DIR / name).exists()):
+            missing.append((profile, name))
+
+    if missing:
+        image_params = {"filename": image_path}
+
+        if svg:
+            image_params["background"] = Color('transparent')
+
+        with Image(**image_params) as image:
+            for profile, name in missing:
+                with image.clone() as thumbnail:
+                    thumbnail.thumbnail(profile.size, profile.size)
+                    thumbnail.save(filename=THUMBNAILS_DIR / name)
+
+    if force or not {name for _, name in variants}.issubset(record.thumbnails):
+        database.files.update_many({"hash": record.hash}, {"$addToSet": {
+            "thumbnails": {"$each": [name for _, name in variants]},
+        }})
+
+    return variants
+
+
+def has_thumbnails(file_type: str) -> bool:
+    # Don't thumbnail GIFs
+    return file_type.startswith("image/") and file_type != "image/gif"
+
+
+def thumbnail_file(path: Path, file_type: str = None, stat: os.stat_result = None) -> list[tuple[ThumbnailProfile, str]]:
+    """
+    Generate the thumbnails for a file if it is an image that gets them, and
+    return (profile, name) pairs for each variant.
+    """
+    if file_type is None:
+        file_type = sniff(path)
+    if not has_thumbnails(file_type):
+        return []
+    elif file_type == "image/svg":
+        return generate_thumbnails(path, svg=True, stat=stat)
+    return generate_thumbnails(path, stat=stat)
+
+
+def find_thumbnails(entries: list[ListedFile]) -> dict[str, list[tuple[ThumbnailProfile, str]]]:
+    """
+    Look up the thumbnail variants that already exist for a batch of files
+    with one query, without hashing or decoding anything. Files that aren't
+    indexed, have changed since they were or are missing a variant are left
+    out.
+    """
+    if not entries:
+        return {}
+    records: list[FileRecord] = database.files.find({"path": {"$in": [entry.path for entry in entries]}})
+    records_by_path = {record.path: record for record in records}
+    results = {}
+    for entry in entries:
+        record = records_by_path.get(entry.path)
+        if record is None or record.mtime != entry.stat.st_mtime or record.size != entry.stat.st_size:
+            continue
+        variants = [(profile, profile.name(record.hash)) for profile in THUMBNAIL_PROFILES]
+        if all(name in record.thumbnails for _, name in variants):
+            results[entry.path] = variants
+    return results
+
+
+# Files with thumbnails waiting to be generated, so each is only queued once
+queued_thumbnails: set[str] = set()
+
+
+def generate_queued_thumbnails(paths: list[Path]):
+    """
+    Generate thumbnails for files queued by queue_thumbnails(). Runs in a
+    worker thread after the response is sent.
+    """
+    try:
+        for path in paths:
+            try:
+                thumbnail_file(path)
+            except Exception:
+                traceback.print_exc()
+    finally:
+        queued_thumbnails.difference_update(str(path) for path in paths)
 
-    with Image(**image_params) as image:
-        with image.clone() as thumbnail:
-            thumbnail.thumbnail(128, 128)
-            thumbnail.save(filename=thumbnail_path)
 
+def queue_thumbnails(background_tasks: BackgroundTasks, paths: Iterable[Path]):
+    """
+    Generate thumbnails for files after responding, skipping any that are
+    already queued.
+    """
+    paths = [path for path in paths if str(path) not in queued_thumbnails]
+    if paths:
+        queued_thumbnails.update(str(path) for path in paths)
+        background_tasks.add_task(generate_queued_thumbnails, paths)
 
-def delete_thumbnail(image_path: Path):
-    thumbnail_path = THUMBNAILS_DIR / (hashlib.sha256(bytes(image_path)).hexdigest() + ".png")
-    thumbnail_path.unlink(missing_ok=True)
 
+def resolve_file_url(url: str) -> Optional[Path]:
+    """
+    Map a URL under /files/ to the file it refers to, or None if the URL
+    is outside of the files root.
+    """
+    parts = Path(os.path.normpath(url)).parts
+    if len(parts) < 3 or parts[0] != "/" or parts[1] != FILES_ROOT.name:
+        return None
+    return FILES_ROOT.joinpath(*parts[2:])
 
 
 def validate_path(requester: User, path: str) -> Path:
@@ -194,6 +664,8 @@ def validate_path(requester: User, path: str) -> Path:
     path = user_root / Path(str(path)[1:])
     if path == user_root:
         raise JsonError("invalid path: file root")
+    if is_internal_path(path):
+        raise JsonError("invalid path: internal directory")
     return path
 
 
@@ -207,6 +679,8 @@ def validate_directory(requester: User, path: str) -> Path:
     # Make path relative to user root
     user_root = requester.file_root
     path = user_root / Path(str(path)[1:])
+    if is_internal_path(path):
+        raise JsonError("invalid path: internal directory")
     # Check that path is a directory that exists
     if not path.is_dir():
         raise JsonError("not a directory")
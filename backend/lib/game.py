@@ -18,13 +18,10 @@ async def send_message(content: str, *, user: User, speaker: str = "System", cha
     # Inform subscribers
     full_broadcast = jsonable_encoder(message.model_dump())
     full_broadcast["type"] = "send"
-    full_broadcast["pool"] = "messages"
     foreign_broadcast = jsonable_encoder(message.foreign_dict())
     foreign_broadcast["type"] = "send"
-    foreign_broadcast["pool"] = "messages"
-    for connection in get_pool("messages"):
-        if language == Language.COMMON or language in connection.user.languages:
-            await connection.send(full_broadcast)
-        else:
-            await connection.send(foreign_broadcast)
+    if language == Language.COMMON:
+        await get_pool("messages").broadcast(full_broadcast)
+    else:
+        await get_pool("messages").broadcast(full_broadcast, language, foreign_broadcast)
     return message
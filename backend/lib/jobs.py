@@ -0,0 +1,183 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from . import database
+from .backplane import backplane
+from .files import delete_file_records
+from ..models.database_models import get_pool
+
+
+PROGRESS_INTERVAL = 0.5
+RECORD_BATCH_SIZE = 500
+
+
+@dataclass
+class FileJob:
+    type: str
+    user_id: str
+    path: str
+    id: str = ""
+    status: str = "running"
+    done: int = 0
+    error: Optional[str] = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    task: Optional[asyncio.Task] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "type": self.type,
+            "user": self.user_id,
+            "path": self.path,
+            "status": self.status,
+            "done": self.done,
+            "error": self.error,
+        }
+
+    def document(self) -> Dict[str, Any]:
+        document = self.to_dict()
+        del document["id"]
+        if self.status != "running":
+            document["finished"] = datetime.utcnow()
+        return document
+
+
+# Jobs running on this worker. Every worker's jobs are recorded in
+# database.file_jobs, and cancelled through the backplane.
+file_jobs: Dict[str, FileJob] = {}
+
+
+async def broadcast_job(job: FileJob):
+    await asyncio.to_thread(database.file_jobs.update_many, job.id, {"$set": job.document()})
+    await get_pool("files").broadcast({
+        "type": "job",
+        "job": job.to_dict(),
+    })
+
+
+async def cancel_file_job(job_id: str):
+    """
+    Ask whichever worker runs a job to cancel it.
+    """
+    await backplane.publish({"kind": "job-cancel", "id": job_id})
+
+
+async def on_job_cancel(message: Dict[str, Any]):
+    job = file_jobs.get(message["id"])
+    if job is not None:
+        job.cancel()
+
+
+backplane.on("job-cancel", on_job_cancel)
+
+
+async def report_progress(job: FileJob):
+    try:
+        await broadcast_job(job)
+    except Exception:
+        traceback.print_exc()
+
+
+async def run_file_job(job: FileJob, on_finish: Optional[Callable[[], Awaitable[None]]], func: Callable, *args):
+    loop = asyncio.get_running_loop()
+    last_report = 0
+    progress: Optional[concurrent.futures.Future] = None
+
+    # Called from the worker thread; throttles progress broadcasts, and never
+    # starts one before the last has been written
+    def report():
+        nonlocal last_report, progress
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL and (progress is None or progress.done()):
+            last_report = now
+            progress = asyncio.run_coroutine_threadsafe(report_progress(job), loop)
+
+    try:
+        try:
+            await asyncio.to_thread(func, job, *args, report)
+            job.status = "cancelled" if job.cancelled else "done"
+        except Exception as exc:
+            job.status = "error"
+            job.error = str(exc)
+        if on_finish is not None:
+            await on_finish()
+    except Exception:
+        traceback.print_exc()
+    finally:
+        # A late progress update mustn't overwrite the final status
+        if progress is not None:
+            await asyncio.wrap_future(progress)
+        try:
+            await broadcast_job(job)
+        except Exception:
+            traceback.print_exc()
+        del file_jobs[job.id]
+
+
+def start_file_job(type: str, user_id: str, path: str, func: Callable, *args, on_finish: Callable[[], Awaitable[None]] = None) -> FileJob:
+    """
+    Run func(job, *args, report) in a worker thread, tracked as a job that
+    can be listed and cancelled. func should call report() as it makes
+    progress and stop early once job.cancelled is set. on_finish is awaited
+    on the event loop before the job's final status is broadcast.
+    """
+    job = FileJob(type, user_id, path)
+    job.id = database.file_jobs.insert_one(job.document())
+    file_jobs[job.id] = job
+    job.task = asyncio.create_task(run_file_job(job, on_finish, func, *args))
+    return job
+
+
+def delete_tree(job: FileJob, path: Path, report: Callable[[], None]):
+    """
+    Delete a file or directory tree bottom-up without following symlinks,
+    removing deleted files from the file index in batches.
+    """
+    batch = []
+
+    def deleted(file_path: Path):
+        job.done += 1
+        batch.append(file_path)
+        if len(batch) >= RECORD_BATCH_SIZE:
+            delete_file_records(batch)
+            batch.clear()
+        report()
+
+    try:
+        if not path.is_dir() or path.is_symlink():
+            path.unlink()
+            deleted(path)
+            return
+
+        for dirpath, dirnames, filenames, dirfd in os.fwalk(path, topdown=False):
+            for name in filenames:
+                if job.cancelled:
+                    return
+                os.unlink(name, dir_fd=dirfd)
+                deleted(Path(dirpath) / name)
+            for name in dirnames:
+                try:
+                    os.rmdir(name, dir_fd=dirfd)
+                except NotADirectoryError:
+                    # Symlinks to directories are listed with the directories
+                    os.unlink(name, dir_fd=dirfd)
+                    deleted(Path(dirpath) / name)
+        os.rmdir(path)
+    finally:
+        if batch:
+            delete_file_records(batch)
@@ -1 +1,120 @@
+import asyncio
+import traceback
+from bson import ObjectId
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from .backplane import backplane
+
+
+# Users online as of the last sweep, by number of live leases
 connected_users: dict[str, int] = {}
+
+# Connections heartbeat every 5 seconds, but browsers may slow that down to
+# once a minute in background tabs
+LEASE_DURATION = timedelta(seconds=90)
+# Lets a reloading tab reconnect without the user going offline
+DISCONNECT_GRACE = timedelta(seconds=5)
+SWEEP_INTERVAL = 2.0
+
+
+class PresenceService:
+    """
+    Tracks which users are online from leases held by their websocket
+    connections. Leases live in a collection shared by all workers, are
+    renewed by heartbeats and expire when a connection goes quiet.
+
+    Every worker sweeps the leases periodically to refresh its view of who is
+    online, and the backplane leader announces users coming online or going
+    offline, so brief reconnects are never announced.
+    """
+
+    def __init__(self, leases, announce: Callable[[str, bool], Awaitable[None]]):
+        self.leases = leases
+        self.announce = announce
+        # Leases held by this worker's connections, and those heartbeated since the last sweep
+        self.held: Dict[str, str] = {}
+        self.renewed: Set[str] = set()
+        self.announced: Optional[Set[str]] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.held:
+            await asyncio.to_thread(self.leases.update_many, self.held_filter(self.held), {
+                "$set": {"expires": datetime.utcnow() + DISCONNECT_GRACE},
+            })
+
+    async def connect(self, user_id: str) -> str:
+        lease_id = await asyncio.to_thread(self.leases.insert_one, {
+            "user_id": user_id,
+            "expires": datetime.utcnow() + LEASE_DURATION,
+        })
+        self.held[lease_id] = user_id
+        connected_users[user_id] = connected_users.get(user_id, 0) + 1
+        return lease_id
+
+    def heartbeat(self, lease_id: str):
+        if lease_id in self.held:
+            self.renewed.add(lease_id)
+
+    async def disconnect(self, lease_id: str):
+        if lease_id not in self.held:
+            return
+        self.renewed.discard(lease_id)
+        await asyncio.to_thread(self.leases.update_many, self.held_filter([lease_id]), {
+            "$set": {"expires": datetime.utcnow() + DISCONNECT_GRACE},
+        })
+        # Still held if interrupted, so shutting down cuts it short instead
+        del self.held[lease_id]
+
+    @staticmethod
+    def held_filter(lease_ids) -> dict:
+        return {"_id": {"$in": [ObjectId(lease_id) for lease_id in lease_ids]}}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception:
+                traceback.print_exc()
+
+    async def sweep(self):
+        now = datetime.utcnow()
+        if self.renewed:
+            renewed, self.renewed = self.renewed, set()
+            matched = await asyncio.to_thread(self.leases.update_many, self.held_filter(renewed), {
+                "$set": {"expires": now + LEASE_DURATION},
+            })
+            # A lease may have expired while its connection was still open
+            if matched < len(renewed):
+                for lease_id in renewed:
+                    if lease_id in self.held:
+                        await asyncio.to_thread(self.leases.upsert, {"id": lease_id}, {"$set": {
+                            "user_id": self.held[lease_id],
+                            "expires": now + LEASE_DURATION,
+                        }})
+
+        counts = await asyncio.to_thread(self.leases.aggregate, [
+            {"$match": {"expires": {"$gt": now}}},
+            {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
+        ])
+        online = {count["_id"]: count["count"] for count in counts}
+        connected_users.clear()
+        connected_users.update(online)
+
+        if not backplane.leader:
+            self.announced = None
+            return
+        # Only announce changes seen since this worker became the leader
+        if self.announced is not None:
+            for user_id in online.keys() - self.announced:
+                await self.announce(user_id, True)
+            for user_id in self.announced - online.keys():
+                await self.announce(user_id, False)
+        self.announced = set(online)
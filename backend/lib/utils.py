@@ -1,6 +1,7 @@
 import os
 from contextlib import contextmanager
 from datetime import datetime
+from typing import Optional
 
 from .errors import AuthError, JsonError
 
@@ -42,6 +43,14 @@ def require(expr, message: str = "unknown error"):
     return expr
 
 
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    # Weak comparison, as required for If-None-Match
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
 def assert_no_mongo_operators(obj):
     objects_to_scan = [obj]
     while objects_to_scan:
@@ -0,0 +1,291 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+from pathlib import Path
+from typing import Optional
+
+from .backplane import backplane
+from .files import ListedFile, scan_directory
+from ..models.database_models import FILES_ROOT, get_pool
+
+
+# "inotify" falls back to polling when inotify is unavailable
+FILE_WATCHER = os.environ.get("FILE_WATCHER", "inotify").lower()
+POLL_INTERVAL = float(os.environ.get("FILE_WATCHER_POLL_INTERVAL") or 5)
+DEBOUNCE_INTERVAL = 0.25
+MAX_ANNOUNCED_CHANGES = 100
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path: Path) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), str(path))
+        return wd
+
+    def remove_watch(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """
+        Yield (wd, mask, name) for every pending event.
+        """
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileIndex:
+    """
+    In-memory index of every directory under the files root. Directories
+    that change are rescanned and diffed against the index, either when
+    inotify reports a change or, without inotify, every POLL_INTERVAL
+    seconds. Changes that weren't made through the API, on any worker, are
+    announced to the files pool.
+    """
+    def __init__(self, root: Path):
+        self.root = root
+        self.directories: dict[Path, dict[str, ListedFile]] = {}
+        self.inotify: Optional[Inotify] = None
+        self.watches: dict[int, Path] = {}
+        self.dirty: set[Path] = set()
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.flush_lock = asyncio.Lock()
+        self.tasks: set[asyncio.Task] = set()
+        self.running = False
+
+    async def start(self):
+        if FILE_WATCHER == "off":
+            return
+        if FILE_WATCHER == "inotify":
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as exc:
+                print("File Index - inotify unavailable, polling -", exc)
+        try:
+            directories, watches = await asyncio.to_thread(self.scan_tree, self.root)
+        except OSError as exc:
+            # Most likely out of inotify watches
+            print("File Index - inotify failed, polling -", exc)
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+            directories, watches = await asyncio.to_thread(self.scan_tree, self.root)
+        self.directories.update(directories)
+        self.watches.update(watches)
+        self.running = True
+
+        if self.inotify is not None:
+            asyncio.get_running_loop().add_reader(self.inotify.fd, self.on_inotify)
+        else:
+            self.spawn(self.poll())
+
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def scan_tree(self, root: Path) -> tuple[dict[Path, dict[str, ListedFile]], dict[int, Path]]:
+        """
+        Watch and scan a directory and all of its subdirectories. Each
+        directory is watched before it is scanned so no change is missed.
+        """
+        directories = {}
+        watches = {}
+        pending = [root]
+        while pending:
+            path = pending.pop()
+            if self.inotify is not None:
+                try:
+                    watches[self.inotify.add_watch(path)] = path
+                except FileNotFoundError:
+                    continue
+            try:
+                entries = scan_directory(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            directories[path] = {entry.name: entry for entry in entries}
+            pending.extend(Path(entry.path) for entry in entries if entry.is_dir and not entry.is_symlink)
+        return directories, watches
+
+    def scan_changed(self, path: Path):
+        """
+        Rescan a changed directory, also scanning any subdirectories that
+        aren't indexed yet. Runs outside of the event loop.
+        """
+        try:
+            entries = scan_directory(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return path, None, {}, {}
+        directories = {}
+        watches = {}
+        for entry in entries:
+            subpath = Path(entry.path)
+            if entry.is_dir and not entry.is_symlink and subpath not in self.directories:
+                subdirectories, subwatches = self.scan_tree(subpath)
+                directories.update(subdirectories)
+                watches.update(subwatches)
+        return path, entries, directories, watches
+
+    def apply_scan(self, path: Path, entries: Optional[list[ListedFile]], directories: dict, watches: dict) -> list[tuple[str, ListedFile]]:
+        """
+        Replace the indexed contents of a directory, returning what changed.
+        """
+        self.watches.update(watches)
+        if entries is None:
+            # The parent directory's rescan reports the deletion
+            self.drop_tree(path)
+            return []
+
+        previous = self.directories.get(path, {})
+        current = {entry.name: entry for entry in entries}
+        changes = []
+        for name, entry in current.items():
+            old_entry = previous.get(name)
+            if old_entry is None:
+                changes.append(("created", entry))
+            elif entry.changed_from(old_entry):
+                # Directory mtimes change with their contents, which their
+                # own rescans report
+                if not (entry.is_dir and old_entry.is_dir):
+                    changes.append(("modified", entry))
+            else:
+                # Keep the sniffed type of unchanged files
+                current[name] = old_entry
+        for name, entry in previous.items():
+            if name not in current:
+                changes.append(("deleted", entry))
+                if entry.is_dir:
+                    self.drop_tree(Path(entry.path))
+
+        self.directories[path] = current
+        self.directories.update(directories)
+        return changes
+
+    def drop_tree(self, path: Path):
+        for directory in [d for d in self.directories if d == path or path in d.parents]:
+            del self.directories[directory]
+        for wd, directory in list(self.watches.items()):
+            if directory == path or path in directory.parents:
+                del self.watches[wd]
+                if self.inotify is not None:
+                    self.inotify.remove_watch(wd)
+
+    def entries(self, path: Path) -> list[ListedFile]:
+        """
+        List a directory from the index, or from disk if it isn't indexed.
+        """
+        if self.running and path in self.directories:
+            return list(self.directories[path].values())
+        return scan_directory(path)
+
+    async def refresh(self, path: Path):
+        """
+        Bring a directory up to date right away after the API changed it,
+        so the next listing sees the change and it isn't announced again.
+        Other workers are told to do the same, as their watchers see the
+        change too.
+        """
+        await self.rescan(path)
+        if backplane.shared:
+            await backplane.publish({"kind": "files-refresh", "path": str(path), "worker": os.getpid()})
+
+    async def rescan(self, path: Path):
+        if not self.running or path not in self.directories:
+            return
+        async with self.flush_lock:
+            self.apply_scan(*await asyncio.to_thread(self.scan_changed, path))
+
+    async def on_refresh(self, message: dict):
+        if message["worker"] != os.getpid():
+            # Don't hold up the backplane while scanning
+            self.spawn(self.rescan(Path(message["path"])))
+
+    def on_inotify(self):
+        for wd, mask, _ in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.dirty.update(self.directories)
+            elif mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif (path := self.watches.get(wd)) is not None:
+                self.dirty.add(path)
+        if self.dirty and self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                DEBOUNCE_INTERVAL,
+                lambda: self.spawn(self.flush()),
+            )
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            self.dirty.update(self.directories)
+            await self.flush()
+
+    async def flush(self):
+        async with self.flush_lock:
+            self.flush_handle = None
+            dirty, self.dirty = self.dirty, set()
+            scans = await asyncio.to_thread(lambda: [self.scan_changed(path) for path in dirty])
+            changes = []
+            for scan in scans:
+                changes.extend(self.apply_scan(*scan))
+            if changes:
+                await self.announce(changes)
+
+    async def announce(self, changes: list[tuple[str, ListedFile]]):
+        # Every worker keeps its own index, but one announcement is enough
+        if not backplane.leader:
+            return
+        await get_pool("files").broadcast({
+            "type": "external",
+            "count": len(changes),
+            "changes": [
+                {"change": change, "path": "/" + str(Path(entry.path).relative_to(self.root))}
+                for change, entry in changes[:MAX_ANNOUNCED_CHANGES]
+            ],
+        })
+
+
+file_index = FileIndex(FILES_ROOT)
+backplane.on("files-refresh", file_index.on_refresh)
@@ -0,0 +1,132 @@
+import json
+import msgpack
+import os
+import struct
+import time
+import zlib
+from typing import Any, Optional, Union
+
+
+# Encodings a client can ask for in its handshake, in order of preference
+ENCODINGS = ("msgpack", "json")
+
+# "deflate" compresses frames in the app for clients that ask for it,
+# "transport" leaves it to the server's permessage-deflate and "off" disables
+# both
+WS_COMPRESSION = (os.environ.get("WS_COMPRESSION") or "deflate").lower()
+WS_COMPRESSION_THRESHOLD = int(os.environ.get("WS_COMPRESSION_THRESHOLD") or 1024)
+WS_COMPRESSION_LEVEL = int(os.environ.get("WS_COMPRESSION_LEVEL") or 6)
+WS_COMPRESSION_WINDOW_BITS = int(os.environ.get("WS_COMPRESSION_WINDOW_BITS") or 15)
+WS_COMPRESSION_CONTEXT_TAKEOVER = os.environ.get("WS_COMPRESSION_CONTEXT_TAKEOVER", "").lower() in ("1", "true", "yes")
+
+# Binary frames to a client that offered compression start with a flags byte,
+# and deflated ones with the length of the payload before compression
+FLAG_DEFLATE = 0x01
+FLAG_MSGPACK = 0x02
+FRAME_LENGTH = struct.Struct("!I")
+
+
+def negotiate(requested: Any) -> str:
+    """
+    Pick the first encoding offered by a client that the server supports.
+    Clients that don't offer any get JSON.
+    """
+    if isinstance(requested, str):
+        requested = [requested]
+    if isinstance(requested, list):
+        for encoding in requested:
+            if encoding in ENCODINGS:
+                return encoding
+    return "json"
+
+
+def encode(obj: Any, encoding: str) -> Union[str, bytes]:
+    """
+    Encode an outgoing message as a text frame for JSON, or a binary frame.
+    """
+    if encoding == "msgpack":
+        return msgpack.packb(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+class CompressionMetrics:
+    def __init__(self):
+        self.skipped_frames = 0
+        self.skipped_bytes = 0
+        self.compressed_frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_ns = 0
+
+    def report(self) -> dict:
+        """
+        Totals since the worker started. A frame shared by several connections
+        is only compressed, and counted, once.
+        """
+        return {
+            "skipped_frames": self.skipped_frames,
+            "skipped_bytes": self.skipped_bytes,
+            "compressed_frames": self.compressed_frames,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": self.bytes_out / self.bytes_in if self.bytes_in else None,
+            "cpu_seconds": self.cpu_ns / 1e9,
+            "cpu_us_per_frame": self.cpu_ns / 1e3 / self.compressed_frames if self.compressed_frames else None,
+            "cpu_ns_per_byte": self.cpu_ns / self.bytes_in if self.bytes_in else None,
+        }
+
+
+compression_metrics = CompressionMetrics()
+
+
+class Compression:
+    """
+    Deflate compression offered by one connection. Frames are raw deflate
+    blocks ending in a sync flush, so the client inflates them all as one
+    stream. Without context takeover each frame is compressed on its own, and
+    the same frame can be sent to every connection. With it, the connection
+    keeps a compressor whose history makes later frames smaller.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.context = self.compressor() if enabled and WS_COMPRESSION_CONTEXT_TAKEOVER else None
+
+    @staticmethod
+    def compressor():
+        return zlib.compressobj(WS_COMPRESSION_LEVEL, zlib.DEFLATED, -WS_COMPRESSION_WINDOW_BITS)
+
+    @property
+    def shared(self) -> bool:
+        return self.context is None
+
+    def pack(self, payload: Union[str, bytes]) -> Union[str, bytes]:
+        data = payload.encode() if isinstance(payload, str) else payload
+        flags = 0 if isinstance(payload, str) else FLAG_MSGPACK
+        if not self.enabled:
+            return payload if isinstance(payload, str) else bytes([flags]) + data
+        if len(data) < WS_COMPRESSION_THRESHOLD:
+            compression_metrics.skipped_frames += 1
+            compression_metrics.skipped_bytes += len(data)
+            return payload if isinstance(payload, str) else bytes([flags]) + data
+
+        start = time.thread_time_ns()
+        context = self.context or self.compressor()
+        compressed = context.compress(data) + context.flush(zlib.Z_SYNC_FLUSH)
+        compression_metrics.cpu_ns += time.thread_time_ns() - start
+        compression_metrics.compressed_frames += 1
+        compression_metrics.bytes_in += len(data)
+        compression_metrics.bytes_out += len(compressed)
+        return bytes([flags | FLAG_DEFLATE]) + FRAME_LENGTH.pack(len(data)) + compressed
+
+
+def negotiate_compression(requested: Any) -> Optional[Compression]:
+    """
+    Clients that offer deflate get flagged binary frames, which are only
+    compressed if the server is configured to.
+    """
+    if isinstance(requested, str):
+        requested = [requested]
+    if isinstance(requested, list) and "deflate" in requested:
+        return Compression(WS_COMPRESSION == "deflate")
+    return None
@@ -1,18 +1,23 @@
 from __future__ import annotations
 
+import json
+import time
+from collections import deque
 from dataclasses import dataclass, field
 from datetime import datetime
 from fastapi import WebSocket
 from fastapi.encoders import jsonable_encoder
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import Any, Dict, Iterator, List, Optional, Union, Set
+from pydantic import BaseModel, Field, field_validator
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple, Union, Set
 
 from ..lib.enums import (
     Alignment, Language, Permissions,
     Layer, GridColor, AbilityType,
     ScaleType
 )
+from ..lib import wire
+from ..lib.backplane import backplane
 from ..lib.utils import current_timestamp
 from ..lib.presence import connected_users
 
@@ -25,29 +30,141 @@ class Connection:
     user: User
     websocket: WebSocket
     pools: Set[Pool] = field(default_factory=set)
+    lease_id: Optional[str] = None
+    encoding: str = "json"
+    compression: Optional[wire.Compression] = None
 
     async def send(self, jsonable):
-        await self.websocket.send_json(jsonable)
+        await self.send_frame(self.pack(wire.encode(jsonable, self.encoding)))
+
+    def pack(self, payload: Union[str, bytes]) -> Union[str, bytes]:
+        if self.compression is None:
+            return payload
+        return self.compression.pack(payload)
+
+    async def send_frame(self, frame: Union[str, bytes]):
+        if isinstance(frame, bytes):
+            await self.websocket.send_bytes(frame)
+        else:
+            await self.websocket.send_text(frame)
 
     def __hash__(self):
         return hash(id(self))
 
 
+POOL_HISTORY_SIZE = 256
+# Pools without connections, and their history, are dropped once unused for
+# this long. Clients that come back later are told to resync.
+POOL_IDLE_TIMEOUT = 300.0
+POOL_EVICT_INTERVAL = 60.0
+
+
 class Pool:
     def __init__(self, name: str):
         self.connections: Set[Connection] = set()
         self.name = name
+        self.seq = 0
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=POOL_HISTORY_SIZE)
+        self.last_used = time.monotonic()
 
     def add(self, connection: Connection):
         self.connections.add(connection)
 
     def discard(self, connection: Connection):
         self.connections.discard(connection)
+        self.last_used = time.monotonic()
+
+    @property
+    def idle(self) -> bool:
+        return not self.connections and time.monotonic() - self.last_used >= POOL_IDLE_TIMEOUT
+
+    async def subscribe(self, connection: Connection, since: Optional[int] = None, epoch: Optional[str] = None):
+        """
+        Add a connection to the pool. If the connection was subscribed before,
+        since is the last sequence number it saw, and it is sent what it
+        missed, or told to resync if that is no longer available.
+        """
+        if since is not None:
+            # Sequence numbers only mean something within one backplane
+            missed = self.since(since) if epoch == backplane.epoch else None
+            while missed:
+                for message in missed:
+                    await connection.send(self.event_for(message, connection))
+                missed = self.since(missed[-1]["seq"])
+            if missed is None:
+                self.add(connection)
+                await connection.send({"pool": self.name, "type": "resync", "seq": self.seq, "epoch": backplane.epoch})
+                return
+        # Nothing is awaited between the last catch up and joining the pool
+        self.add(connection)
+        await connection.send({"pool": self.name, "type": "subscribed", "seq": self.seq, "epoch": backplane.epoch})
+
+    def since(self, seq: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Get the events broadcast after the given sequence number, or None if
+        some of them have fallen out of the history.
+        """
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self.history or self.history[0]["seq"] > seq + 1:
+            return None
+        return [message for message in self.history if message["seq"] > seq]
 
-    async def broadcast(self, obj: Dict[str, Any]):
-        obj["pool"] = self.name
-        for connection in self.connections:
-            await connection.send(obj)
+    async def broadcast(self, obj: Dict[str, Any], language: Optional[Language] = None, foreign: Optional[Dict[str, Any]] = None):
+        """
+        Send an event to the pool's connections on every worker. If foreign is
+        given, users who don't speak the language are sent it instead.
+        """
+        await backplane.publish({
+            "kind": "event",
+            "pool": self.name,
+            "event": obj,
+            "language": language,
+            "foreign": foreign,
+        })
+
+    async def deliver(self, message: Dict[str, Any]):
+        """
+        Send an event that came through the backplane to this worker's
+        connections.
+        """
+        for obj in (message["event"], message.get("foreign")):
+            if obj is not None:
+                obj["pool"] = self.name
+                obj["seq"] = message["seq"]
+        self.seq = message["seq"]
+        self.history.append(message)
+        # Encode and compress each variant once, however many connections get
+        # it, unless connections compress with their own context
+        payloads: Dict[Tuple[int, str], Union[str, bytes]] = {}
+        frames: Dict[Tuple[int, str], Union[str, bytes]] = {}
+        for connection in list(self.connections):
+            obj = self.event_for(message, connection)
+            key = (id(obj), connection.encoding)
+            payload = payloads.get(key)
+            if payload is None:
+                payload = payloads[key] = wire.encode(obj, connection.encoding)
+            if connection.compression is None:
+                frame = payload
+            elif connection.compression.shared:
+                frame = frames.get(key)
+                if frame is None:
+                    frame = frames[key] = connection.compression.pack(payload)
+            else:
+                frame = connection.compression.pack(payload)
+            try:
+                await connection.send_frame(frame)
+            except Exception:
+                # A closing connection shouldn't keep the event from the rest,
+                # and it is unsubscribed from everything once its socket ends
+                self.discard(connection)
+
+    @staticmethod
+    def event_for(message: Dict[str, Any], connection: Connection) -> Dict[str, Any]:
+        foreign = message.get("foreign")
+        if foreign is None or message["language"] in connection.user.languages:
+            return message["event"]
+        return foreign
 
     def __iter__(self) -> Iterator[Connection]:
         return iter(self.connections)
@@ -58,6 +175,7 @@ class Pool:
 
 MESSAGE_POOL = Pool("messages")
 EVENT_POOLS: Dict[str, Pool] = {}
+last_pool_eviction = time.monotonic()
 
 
 def get_pool(request: Union[str, Dict[str, Any]]):
@@ -66,13 +184,56 @@ def get_pool(request: Union[str, Dict[str, Any]]):
         pool_name = request
     else:
         pool_name = request.get("pool")
+    evict_idle_pools()
     pool = EVENT_POOLS.get(pool_name)
     if pool is None:
         pool = Pool(pool_name)
         EVENT_POOLS[pool_name] = pool
+    pool.last_used = time.monotonic()
     return pool
 
 
+def evict_idle_pools():
+    global last_pool_eviction
+    now = time.monotonic()
+    if now - last_pool_eviction < POOL_EVICT_INTERVAL:
+        return
+    last_pool_eviction = now
+    for name, pool in list(EVENT_POOLS.items()):
+        if pool.idle:
+            del EVENT_POOLS[name]
+
+
+async def broadcast_to_pools(pool_names: List[str], obj: Dict[str, Any]):
+    """
+    Send the same event to many pools with a single backplane message. Each
+    worker only hands it to the pools it already has.
+    """
+    if pool_names:
+        await backplane.publish({
+            "kind": "event",
+            "pools": pool_names,
+            "event": obj,
+            "language": None,
+            "foreign": None,
+        })
+
+
+async def deliver(message: Dict[str, Any]):
+    """
+    Handle a message from the backplane.
+    """
+    if message["kind"] != "event":
+        return
+    if "pools" not in message:
+        await get_pool(message["pool"]).deliver(message)
+        return
+    for pool_name, seq in zip(message["pools"], message["seqs"]):
+        pool = EVENT_POOLS.get(pool_name)
+        if pool is not None:
+            await pool.deliver({**message, "event": dict(message["event"]), "seq": seq})
+
+
 def new_permissions():
     return {"*": {"*": Permissions.NONE}}
 
@@ -108,6 +269,12 @@ class Session(BaseModel):
     last_auth_date: datetime = Field(default_factory=datetime.utcnow)
 
 
+class Lease(BaseModel):
+    id: str
+    user_id: str
+    expires: datetime
+
+
 class Entry(BaseModel):
     id: str = None
     name: Optional[str] = None
@@ -162,6 +329,48 @@ class Entry(BaseModel):
         """
         return self.get_permission(id, field) >= level
 
+    @staticmethod
+    def permission_filter(id: str = "*", field: str = "*", level: Permissions = Permissions.READ) -> Dict[str, Any]:
+        """
+        Build a mongo filter matching the documents for which has_permission()
+        would return True, so unreadable documents are never fetched.
+        """
+        if level <= Permissions.INHERIT:
+            return {}
+
+        def resolves_to_at_least(key: str):
+            if field == "*":
+                return {f"permissions.{key}.*": {"$gte": level}}
+            return {"$or": [
+                {f"permissions.{key}.{field}": {"$gte": level}},
+                {f"permissions.{key}.{field}": {"$exists": False}, f"permissions.{key}.*": {"$gte": level}},
+            ]}
+
+        def resolves_to_inherit(key: str):
+            if field == "*":
+                return {f"permissions.{key}.*": {"$not": {"$gt": Permissions.INHERIT}}}
+            return {"$or": [
+                {f"permissions.{key}.{field}": {"$lte": Permissions.INHERIT}},
+                {f"permissions.{key}.{field}": {"$exists": False}, f"permissions.{key}.*": {"$not": {"$gt": Permissions.INHERIT}}},
+            ]}
+
+        if id == "*":
+            return resolves_to_at_least("*")
+        # Specific IDs fall back to "*" when their own permission is missing or inherited
+        return {"$or": [
+            resolves_to_at_least(id),
+            {"$and": [resolves_to_inherit(id), resolves_to_at_least("*")]},
+        ]}
+
+
+class EntryStub(Entry):
+    """
+    The fields of an entry needed to list it, without its contents.
+    """
+    data: Dict = Field(default_factory=dict, exclude=True)
+    folder_id: Optional[str] = None
+    entry_type: str = "entry"
+
 
 class Entity(Entry):
     stat_map: Dict[str, Stat] = Field(default_factory=dict)
@@ -191,6 +400,7 @@ class Item(Entity, Container):
 class Folder(Entry):
     entry_type: str = "folder"
     parent_id: Optional[str] = None
+    ancestors: List[str] = Field(default_factory=list)
     alternate_id: Optional[str] = None
 
 
@@ -208,6 +418,7 @@ class Character(Entity, Container):
     max_actions: int = 1
     reactions: int = 0
     max_reactions: int = 2
+    initiative: str = "2d6"
     sheet_type: str = "default"
     ability_map: Dict[str, CharacterAbility] = Field(default_factory=dict)
     ability_order: List[str] = Field(default_factory=list)
@@ -223,6 +434,14 @@ class Ability(Entry):
     rolls: list[Roll] = Field(default_factory=list)
 
 
+class AbilityStub(EntryStub):
+    """
+    Abilities are listed with the icons for their type and cooldown.
+    """
+    type: AbilityType = AbilityType.PASSIVE
+    cooldown: int = 0
+
+
 class Note(Entry):
     entry_type: str = "note"
     folder_id: Optional[str] = None
@@ -259,6 +478,37 @@ class Combatant(Entry):
 class Combat(Entry):
     entry_type: str = "combat"
     combatants: List[Combatant] = Field(default_factory=list)
+    version: int = 0
+
+
+class CombatEvent(BaseModel):
+    id: str = None
+    combat_id: str
+    seq: int
+    type: str
+    data: Dict = Field(default_factory=dict)
+    timestamp: int = Field(default_factory=current_timestamp)
+
+    @field_validator("data", mode="before")
+    @classmethod
+    def decode_data(cls, value):
+        if isinstance(value, str):
+            return json.loads(value)
+        return value
+
+    def document(self) -> Dict[str, Any]:
+        """
+        The event as stored, with data encoded since update events contain
+        mongo operators, which can't be stored as field names.
+        """
+        document = self.model_dump(exclude={"id"})
+        document["data"] = json.dumps(jsonable_encoder(self.data))
+        return document
+
+    def broadcast_dict(self) -> Dict[str, Any]:
+        # Pools number their own broadcasts as seq, so the event's goes by the
+        # combat version it produced
+        return jsonable_encoder({"type": self.type, **self.data, "version": self.seq})
 
 
 class Token(Entry):
@@ -294,6 +544,26 @@ class Map(Entry):
     backgroundColor: int = "000000"
 
 
+class FileRecord(BaseModel):
+    id: str
+    path: str
+    hash: str
+    mtime: float = 0
+    size: int = 0
+    thumbnails: List[str] = Field(default_factory=list)
+
+
+class FileJobRecord(BaseModel):
+    id: str
+    type: str
+    user: str
+    path: str
+    status: str = "running"
+    done: int = 0
+    error: Optional[str] = None
+    finished: Optional[datetime] = None
+
+
 class Message(BaseModel):
     id: str
     sender_id: str
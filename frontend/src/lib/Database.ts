@@ -1,5 +1,5 @@
 import * as Events from "../lib/Events.ts";
-import { Character, User } from "./Models.ts";
+import { Character, Entry, User } from "./Models.ts";
 import { ApiRequest, Session, Subscribe } from "./Requests.ts";
 import { Bound, ApplyChanges, ResolvePath, IsDefined } from "./Utils.ts";
 import { ErrorToast } from "./Notifications.ts";
@@ -9,11 +9,27 @@ export const users: { [id: string]: User } = {};
 export const characters: { [id: string]: Character } = {};
 
 
+export interface TreeFolder {
+    id: string;
+    name: string;
+    parent_id: string;
+}
+
+export interface TreeEntry extends Entry {
+    folder_id: string;
+}
+
+export interface FolderTree {
+    etag: string;
+    folders: { [id: string]: TreeFolder };
+    entries: { [id: string]: TreeEntry };
+}
+
+const folderTrees: { [entryType: string]: FolderTree } = {};
+
+
 export async function init() {
-    const userListResponse = await ApiRequest("/user/list");
-    for (let user of userListResponse.users) {
-        users[user.id] = user;
-    }
+    await loadUsers();
     await Subscribe("users", update => {
         if (update.type == "create") {
             users[update.user.id] = update.user;
@@ -35,7 +51,67 @@ export async function init() {
             users[update.id].online = false;
             Events.dispatch("userPresence", update.id, false);
         }
-    });
+    }, loadUsers);
+}
+
+
+async function loadUsers() {
+    const userListResponse = await ApiRequest("/user/list");
+    const listed = new Set<string>();
+    for (let user of userListResponse.users) {
+        const known = user.id in users;
+        users[user.id] = user;
+        listed.add(user.id);
+        if (known) {
+            Events.dispatch("userUpdate", user);
+        }
+    }
+    for (let id of Object.keys(users)) {
+        if (!listed.has(id)) {
+            delete users[id];
+            Events.dispatch("userDelete", id);
+        }
+    }
+}
+
+
+/**
+ * Get every folder and entry stub of an entry type the user can see. Once
+ * a tree is loaded only the changes since then are fetched.
+ */
+export async function LoadFolderTree(entryType: string): Promise<FolderTree | null> {
+    const cached = folderTrees[entryType];
+    const response = await ApiRequest(`/folder/${entryType}/tree`, { since: cached?.etag ?? null });
+    if (response.status != "success") {
+        return null;
+    }
+
+    if (response.changes && cached) {
+        for (let folder of response.changes.folders) {
+            cached.folders[folder.id] = folder;
+        }
+        for (let id of response.changes.deleted_folders) {
+            delete cached.folders[id];
+        }
+        for (let entry of response.changes.entries) {
+            cached.entries[entry.id] = entry;
+        }
+        for (let id of response.changes.deleted_entries) {
+            delete cached.entries[id];
+        }
+        cached.etag = response.etag;
+        return cached;
+    }
+
+    const tree: FolderTree = { etag: response.etag, folders: {}, entries: {} };
+    for (let folder of response.folders) {
+        tree.folders[folder.id] = folder;
+    }
+    for (let entry of response.entries) {
+        tree.entries[entry.id] = entry;
+    }
+    folderTrees[entryType] = tree;
+    return tree;
 }
 
 
@@ -102,6 +178,9 @@ export async function TrackCharacter(id: string): Promise<Character> {
         if (update.type == "delete") {
             delete characters[id];
         }
+    }, async () => {
+        delete characters[id];
+        characters[id] = await ResolveCharacter(id);
     });
 
     return characters[id];
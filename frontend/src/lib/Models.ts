@@ -135,6 +135,7 @@ export interface Character extends Entity {
     max_actions: number;
     reactions: number;
     max_reactions: number;
+    initiative: string;
     size: number;
     scale: number;
     sheet_type: string;
@@ -1,4 +1,5 @@
 import { User } from "./Models.ts";
+import { FrameDecoder } from "./Wire.ts";
 import { ErrorToast } from "./Notifications.ts";
 import { Future, Sleep } from "./Async.ts";
 
@@ -10,6 +11,8 @@ export class Session {
     static id: string = null as any;
     static ws: WebSocket;
     static subscriptions: { [pool: string]: Set<Subscription> } = {};
+    static sequences: { [pool: string]: number } = {};
+    static epoch: string = null as any;
     static connectionFailures: number = 0;
 }
 
@@ -20,6 +23,27 @@ export function HandleWsMessage(data: any) {
         console.warn(`Ignoring message bound for pool: ${data.pool}`)
         return;
     }
+    if (data.type == "subscribed" || data.type == "resync") {
+        Session.epoch = data.epoch;
+        Session.sequences[data.pool] = data.seq;
+        if (data.type == "resync") {
+            for (let subscription of pool) {
+                try {
+                    subscription.onResync?.();
+                } catch (error) {
+                    console.error(error);
+                }
+            }
+        }
+        return;
+    }
+    if (typeof data.seq === "number") {
+        const lastSeq = Session.sequences[data.pool];
+        if (typeof lastSeq === "number" && data.seq <= lastSeq) {
+            return;
+        }
+        Session.sequences[data.pool] = data.seq;
+    }
     for (let subscription of pool) {
         try {
             subscription.callback(data);
@@ -35,22 +59,34 @@ export async function WsConnect() {
 
     let ws_prefix = (location.protocol === "https:" ? "wss:" : "ws:");
     Session.ws = new WebSocket(`${ws_prefix}//${location.host}/api/live`);
+    Session.ws.binaryType = "arraybuffer";
     Session.ws.onopen = () => {
         if (Session.connectionFailures >= 5) {
             location.reload();
         }
-        Session.ws.send(JSON.stringify({ "token": Session.token }));
+        // Servers that don't know MessagePack keep sending JSON text frames
+        Session.ws.send(JSON.stringify({
+            "token": Session.token,
+            "encoding": ["msgpack", "json"],
+            "compression": ["deflate"],
+        }));
         for (let [pool, subscription_set] of Object.entries(Session.subscriptions)) {
             if (subscription_set.size != 0) {
-                Session.ws.send(JSON.stringify({ type: "subscribe", pool }));
+                // Resume from the last event seen, if this is a reconnect
+                Session.ws.send(JSON.stringify({
+                    type: "subscribe",
+                    pool,
+                    since: Session.sequences[pool],
+                    epoch: Session.epoch,
+                }));
             }
         }
         Session.connectionFailures = 0;
         connected.resolve(null);
     }
+    const decoder = new FrameDecoder(true);
     Session.ws.onmessage = ev => {
-        const data = JSON.parse(ev.data);
-        HandleWsMessage(data);
+        decoder.push(ev.data, HandleWsMessage);
     };
     Session.ws.onclose = async () => {
         if (Session.connectionFailures < 5) {
@@ -72,23 +108,26 @@ export async function WsConnect() {
 export class Subscription {
     pool: string;
     callback: CallableFunction;
+    onResync: CallableFunction | null;
 
-    constructor(pool: string, callback: CallableFunction) {
+    constructor(pool: string, callback: CallableFunction, onResync: CallableFunction | null = null) {
         this.pool = pool;
         this.callback = callback;
+        this.onResync = onResync;
     }
 
     cancel() {
         let subscription_set = Session.subscriptions[this.pool];
         subscription_set.delete(this);
         if (subscription_set.size == 0) {
+            delete Session.sequences[this.pool];
             Session.ws.send(JSON.stringify({ type: "unsubscribe", pool: this.pool }));
         }
     }
 }
 
 
-export async function Subscribe(pool: string, callback: CallableFunction): Promise<Subscription> {
+export async function Subscribe(pool: string, callback: CallableFunction, onResync: CallableFunction | null = null): Promise<Subscription> {
     let subscription_set = Session.subscriptions[pool];
     if (!subscription_set) {
         subscription_set = new Set();
@@ -97,7 +136,7 @@ export async function Subscribe(pool: string, callback: CallableFunction): Promi
     if (subscription_set.size == 0 && Session.ws && Session.ws.readyState == WebSocket.OPEN) {
         Session.ws.send(JSON.stringify({ type: "subscribe", pool }));
     }
-    let subscription = new Subscription(pool, callback);
+    let subscription = new Subscription(pool, callback, onResync);
     subscription_set.add(subscription);
     return subscription;
 }
@@ -506,13 +506,11 @@ export function Require<T>(argument: T): T {
 
 
 export async function GetThumbnail(url: string): Promise<string> {
-    const encoder = new TextEncoder();
-    let thumbnail = "/thumbnails/";
-    for (let byte of new Uint8Array(await crypto.subtle.digest("SHA-256", encoder.encode(url)))) {
-        thumbnail += byte.toString(16).padStart(2, '0');
+    // Only uploaded files have thumbnails
+    if (!url || !url.startsWith("/files/")) {
+        return url;
     }
-    thumbnail += ".png";
-    return thumbnail;
+    return `/api/files/thumbnail?url=${encodeURIComponent(url)}`;
 }
 
 
@@ -0,0 +1,78 @@
+import { decode } from "@msgpack/msgpack";
+
+
+const FLAG_DEFLATE = 0x01;
+const FLAG_MSGPACK = 0x02;
+
+
+/**
+ * Decodes the frames received on one websocket connection. Deflated frames
+ * are inflated as a single stream, since the server may compress frames
+ * against the ones before them.
+ */
+export class FrameDecoder {
+    flagged: boolean;
+    writer: WritableStreamDefaultWriter<Uint8Array> | null = null;
+    reader: ReadableStreamDefaultReader<Uint8Array> | null = null;
+    pending: Uint8Array = new Uint8Array(0);
+    queue: Promise<void> = Promise.resolve();
+    textDecoder = new TextDecoder();
+
+    constructor(flagged: boolean) {
+        this.flagged = flagged;
+        if (flagged) {
+            const stream = new DecompressionStream("deflate-raw");
+            this.writer = stream.writable.getWriter();
+            this.reader = stream.readable.getReader();
+        }
+    }
+
+    // Inflating is asynchronous, so frames are queued to keep them in order
+    push(data: string | ArrayBuffer, callback: (message: any) => void) {
+        this.queue = this.queue
+            .then(async () => callback(await this.decode(data)))
+            .catch(error => console.error(error));
+    }
+
+    async decode(data: string | ArrayBuffer): Promise<any> {
+        if (typeof data === "string") {
+            return JSON.parse(data);
+        }
+        const bytes = new Uint8Array(data);
+        if (!this.flagged) {
+            return decode(bytes);
+        }
+        const flags = bytes[0];
+        let payload = bytes.subarray(1);
+        if (flags & FLAG_DEFLATE) {
+            const length = new DataView(bytes.buffer, bytes.byteOffset + 1, 4).getUint32(0);
+            payload = await this.inflate(bytes.subarray(5), length);
+        }
+        if (flags & FLAG_MSGPACK) {
+            return decode(payload);
+        }
+        return JSON.parse(this.textDecoder.decode(payload));
+    }
+
+    async inflate(data: Uint8Array, length: number): Promise<Uint8Array> {
+        this.writer!.write(data);
+        const chunks = [this.pending];
+        let size = this.pending.length;
+        while (size < length) {
+            const { value, done } = await this.reader!.read();
+            if (done) {
+                throw Error("deflate stream ended");
+            }
+            chunks.push(value);
+            size += value.length;
+        }
+        const output = new Uint8Array(size);
+        let offset = 0;
+        for (const chunk of chunks) {
+            output.set(chunk, offset);
+            offset += chunk.length;
+        }
+        this.pending = output.subarray(length);
+        return output.subarray(0, length);
+    }
+}
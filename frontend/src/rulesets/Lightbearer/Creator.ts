@@ -147,7 +147,7 @@ export async function LightbearerCreatorRender(container: HTMLDivElement, data:
         parent_id: string,
         subfolders: [string, string][],
         entries: Ability[],
-    } = await ApiRequest("/folder/ability/list", { folder_id: "Lightbearer.BasicActions" });
+    } = await ApiRequest("/folder/ability/list", { folder_id: "Lightbearer.BasicActions", full: true });
 
     basicAbilities = basicResponse.entries;
 
@@ -157,7 +157,7 @@ export async function LightbearerCreatorRender(container: HTMLDivElement, data:
         parent_id: string,
         subfolders: [string, string][],
         entries: Ability[],
-    } = await ApiRequest("/folder/ability/list", { folder_id: "Lightbearer.Weapons" });
+    } = await ApiRequest("/folder/ability/list", { folder_id: "Lightbearer.Weapons", full: true });
 
     for (const ability of weaponResponse.entries) {
         weaponAbilities[ability.name] = ability;
@@ -175,7 +175,7 @@ export async function LightbearerCreatorRender(container: HTMLDivElement, data:
             parent_id: string,
             subfolders: [string, string][],
             entries: Ability[],
-        } = await ApiRequest("/folder/ability/list", { folder_id: `Lightbearer.Classes.${className}` });
+        } = await ApiRequest("/folder/ability/list", { folder_id: `Lightbearer.Classes.${className}`, full: true });
 
         if (response.status !== "success") {
             ErrorToast(`Failed to load class: ${className}`);
@@ -230,7 +230,7 @@ export async function LightbearerCreatorRender(container: HTMLDivElement, data:
             parent_id: string,
             subfolders: [string, string][],
             entries: Ability[],
-        } = await ApiRequest("/folder/ability/list", { folder_id: `Lightbearer.Races.${race}` });
+        } = await ApiRequest("/folder/ability/list", { folder_id: `Lightbearer.Races.${race}`, full: true });
 
         if (response.status !== "success") {
             ErrorToast(`Failed to load race: ${race}`);
@@ -115,16 +115,12 @@ export class CombatTrackerWindow extends ContentWindow {
                 <button type="button" class="add"><i class="fa-solid fa-dice"></i></button>
             `));
             rollAllButton.addEventListener("click", async () => {
-                const changes = {};
-                for (const [_id, index] of Object.entries(this.combatantIndexes)) {
-                    changes[`combatants.${index}.initiative`] = Roll("2d6").total;
-                }
-                await ApiRequest("/combat/update", {
+                const response = await ApiRequest("/combat/roll-initiative", {
                     id: this.combatId,
-                    changes: {
-                        "$set": changes,
-                    },
                 });
+                if (response.status != "success") {
+                    ErrorToast(response.reason);
+                }
             });
         }
 
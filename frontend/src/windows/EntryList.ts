@@ -10,6 +10,7 @@ import { AddDragListener } from "../lib/Drag.ts";
 import { PermissionsWindow } from "./Permissions.ts";
 import { FolderPermissionsWindow } from "./FolderPermissions.ts";
 import { Entry } from "../lib/Models.ts";
+import { LoadFolderTree } from "../lib/Database.ts";
 
 
 export class EntryListWindow extends ContentWindow {
@@ -158,7 +159,13 @@ export class EntryListWindow extends ContentWindow {
         AddDragListener(element, { type: `${this.entryType}Entry`, id: entry.id });
         const contextOptions = {
             "Duplicate": async () => {
-                const newEntry = structuredClone(entry);
+                // Listings only carry stubs, so fetch the whole entry to copy it
+                const response = await ApiRequest(`/${this.entryType}/get`, { id: entry.id });
+                if (response.status != "success") {
+                    ErrorToast(`Failed to duplicate ${this.entryType}.`);
+                    return;
+                }
+                const newEntry = response[this.entryType];
                 newEntry.name += " (Copy)";
                 await ApiRequest(`/${this.entryType}/create`, {
                     document: newEntry
@@ -210,32 +217,34 @@ export class EntryListWindow extends ContentWindow {
             this.folderId = folderId;
         }
 
-        const response: {
-            status: string,
-            name: string,
-            parent_id: string,
-            subfolders: [string, string][],
-            entries: Entry[],
-        } = await ApiRequest(`/folder/${this.entryType}/list`, { folder_id: this.folderId });
-        if (response.status != "success") {
+        // The tree is shared by every list of this entry type, and only
+        // what changed is fetched when it is reloaded
+        const tree = await LoadFolderTree(this.entryType);
+        const folder = this.folderId ? tree?.folders[this.folderId] : null;
+        if (!tree || (this.folderId && !folder)) {
             ErrorToast(`Failed to load ${this.entryType} list.`);
             this.close();
             return;
         }
 
-        if (this.folderId) {
-            this.setTitle(`${Pluralize(TitleCase(this.entryType))} - ${response.name}`);
-            await this.addParentFolder(response.parent_id);
+        if (folder) {
+            this.setTitle(`${Pluralize(TitleCase(this.entryType))} - ${folder.name}`);
+            await this.addParentFolder(folder.parent_id);
         }
         else {
             this.setTitle(`${Pluralize(TitleCase(this.entryType))}`);
         }
 
-        for (let [id, name] of response.subfolders) {
-            await this.addFolder(id, name);
+        const folderId = this.folderId || null;
+        const byName = (a: { name: string }, b: { name: string }) => a.name < b.name ? -1 : a.name > b.name ? 1 : 0;
+
+        const subfolders = Object.values(tree.folders).filter(subfolder => subfolder.parent_id == folderId);
+        for (let subfolder of subfolders.sort(byName)) {
+            await this.addFolder(subfolder.id, subfolder.name);
         }
 
-        for (let entry of response.entries) {
+        const entries = Object.values(tree.entries).filter(entry => entry.folder_id == folderId);
+        for (let entry of entries.sort(byName)) {
             await this.addEntry(entry);
         }
 
@@ -307,6 +316,12 @@ export class EntryListWindow extends ContentWindow {
                     this.refresh();
                 }
             }
+            else if (updateData.type == "permissions") {
+                if (!updateData.folders.includes(this.folderId)) {
+                    return;
+                }
+                this.refresh();
+            }
             else if (updateData.type == "renamedir") {
                 const folderDiv = this.entryList.querySelector(`[data-folder="${updateData.folder}"]`);
                 if (folderDiv) {
@@ -2,7 +2,7 @@ import * as ContextMenu from "../lib/ContextMenu.ts";
 import { ContentWindow, InputDialog, registerWindowType } from "./Window.ts";
 import { ApiRequest, Session, FileUpload } from "../lib/Requests.ts";
 import { Vector2 } from "../lib/Vector.ts";
-import { Parameter, Leaf, Parent, PathConcat, GetThumbnail } from "../lib/Utils.ts";
+import { Parameter, Leaf, Parent, PathConcat } from "../lib/Utils.ts";
 import { ErrorToast } from "../lib/Notifications.ts";
 import { AddDragListener } from "../lib/Drag.ts";
 import { FileViewer } from "./FileViewer.ts";
@@ -149,11 +149,18 @@ export class FileWindow extends ContentWindow {
             }
             else {
                 const img = FILE_ICONS[filetype.split("/").at(0)];
-                this.addFile(filetype, img, name, path);
+                // Use the smallest thumbnail that still fills the image view
+                const thumbnails = response.thumbnails[path];
+                const thumbnail = thumbnails?.find(variant => variant.size >= 128) ?? thumbnails?.at(-1);
+                this.addFile(filetype, img, name, path, thumbnail?.url);
             }
         }
 
-        await this.subscribe("files", () => {
+        await this.subscribe("files", (data) => {
+            // Only refresh once background jobs finish
+            if (data.type == "job" && data.job.status == "running") {
+                return;
+            }
             this.refresh();
         });
     }
@@ -211,7 +218,7 @@ export class FileWindow extends ContentWindow {
         });
     }
 
-    async addFile(filetype: string, img: string, name: string, path: string) {
+    async addFile(filetype: string, img: string, name: string, path: string, thumbnail: string = null) {
         this.fileNames.add(name);
         let urlPath = null;
         if (Session.gm) {
@@ -222,8 +229,7 @@ export class FileWindow extends ContentWindow {
         }
 
         let icon;
-        if (filetype.startsWith("image/")) {
-            const thumbnail = await GetThumbnail(urlPath);
+        if (thumbnail) {
             icon = document.createElement("img");
             icon.classList = "thumbnail";
             icon.src = thumbnail;
@@ -292,7 +292,8 @@ export class BaseWindow {
     }
 
     async subscribe(pool: string, callback: CallableFunction): Promise<Subscription> {
-        const subscription = await Subscribe(pool, callback);
+        // Events missed while disconnected are lost, so start over
+        const subscription = await Subscribe(pool, callback, () => this.refresh());
         this.subscriptions.push(subscription);
         return subscription;
     }
@@ -39,6 +39,36 @@ def list_users(args):
     print(response.content)
 
 
+def file_store(args):
+    response = requests.post(
+        f"{BASE_URL}/admin/file-store",
+        json={
+            "admin_token": ADMIN_TOKEN,
+        }
+    )
+    print(response.content)
+
+
+def collect_blobs(args):
+    response = requests.post(
+        f"{BASE_URL}/admin/file-store/collect",
+        json={
+            "admin_token": ADMIN_TOKEN,
+        }
+    )
+    print(response.content)
+
+
+def websockets(args):
+    response = requests.post(
+        f"{BASE_URL}/admin/websockets",
+        json={
+            "admin_token": ADMIN_TOKEN,
+        }
+    )
+    print(response.content)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
@@ -51,6 +81,15 @@ if __name__ == "__main__":
     list_users_parser = subparsers.add_parser("list_users")
     list_users_parser.set_defaults(func=list_users)
 
+    file_store_parser = subparsers.add_parser("file_store")
+    file_store_parser.set_defaults(func=file_store)
+
+    collect_blobs_parser = subparsers.add_parser("collect_blobs")
+    collect_blobs_parser.set_defaults(func=collect_blobs)
+
+    websockets_parser = subparsers.add_parser("websockets")
+    websockets_parser.set_defaults(func=websockets)
+
     args = parser.parse_args()
     if not hasattr(args, "func"):
         parser.error("no command selected")
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import requests
+import sys
+import time
+import timeit
+from dotenv import load_dotenv
+from pathlib import Path
+
+
+load_dotenv()
+
+
+HTTP_PORT = os.environ.get("HTTP_PORT", None)
+
+if HTTP_PORT is not None:
+    BASE_URL = f"http://127.0.0.1:{HTTP_PORT}"
+else:
+    BASE_URL = f"http://127.0.0.1"
+
+
+def login(args) -> str:
+    response = requests.post(
+        f"{BASE_URL}/api/login",
+        json={
+            "username": args.username,
+            "password": args.password,
+        }
+    )
+    return response.json()["token"]
+
+
+def api(token: str, endpoint: str, **kwargs) -> dict:
+    response = requests.post(f"{BASE_URL}/api/{endpoint}", json={"token": token, **kwargs}).json()
+    if response["status"] != "success":
+        raise RuntimeError(f"{endpoint}: {response.get('reason')}")
+    return response
+
+
+def folder_delete(args):
+    token = login(args)
+    root_id = api(token, f"folder/{args.entry_type}/create", name="benchmark")["id"]
+    # Build a tree with the given fan out until it has the requested size
+    parents = [root_id]
+    created = 1
+    while created < args.folders:
+        children = []
+        for parent_id in parents:
+            for i in range(args.fan_out):
+                if created >= args.folders:
+                    break
+                children.append(api(token, f"folder/{args.entry_type}/create", name=f"benchmark {created}", parent=parent_id)["id"])
+                created += 1
+        parents = children
+
+    start = time.perf_counter()
+    api(token, f"folder/{args.entry_type}/delete", folder_id=root_id)
+    elapsed = time.perf_counter() - start
+    print(f"deleted {created} folders in {elapsed * 1000:.1f} ms")
+
+
+def permissions(args):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    from backend.lib.enums import Permissions
+    from backend.models.database_models import Entry
+
+    class MemoizedEntry(Entry):
+        # Resolved permissions memoized per (id, field) on the instance
+        def get_permission(self, id: str = "*", field: str = "*") -> Permissions:
+            cache = self.__dict__.get("permission_cache", None)
+            if cache is None:
+                cache = self.__dict__["permission_cache"] = {}
+            permission = cache.get((id, field), None)
+            if permission is None:
+                permission = cache[id, field] = super().get_permission(id, field)
+            return permission
+
+    # A listing's worth of entries, each shared with a few players
+    rng = random.Random(0)
+    user_ids = [f"user{i}" for i in range(args.users)]
+    entries = []
+    for i in range(args.entries):
+        entry_permissions = {"*": {"*": rng.choice([Permissions.NONE, Permissions.READ])}}
+        for user_id in rng.sample(user_ids, min(3, len(user_ids))):
+            entry_permissions[user_id] = {"*": rng.choice(list(Permissions))}
+        entries.append(entry_permissions)
+    plain_entries = [Entry(permissions=entry_permissions) for entry_permissions in entries]
+    memoized_entries = [MemoizedEntry(permissions=entry_permissions) for entry_permissions in entries]
+
+    def check(entries):
+        def run():
+            for user_id in user_ids:
+                for entry in entries:
+                    entry.has_permission(user_id, level=Permissions.READ)
+        return run
+
+    def invalidate():
+        for entry in memoized_entries:
+            entry.__dict__.pop("permission_cache", None)
+
+    # Cold includes filling each entry's cache, as for freshly loaded documents
+    checks = args.entries * args.users
+    timings = {}
+    for name, func, setup in (
+        ("resolved", check(plain_entries), "pass"),
+        ("memoized cold", check(memoized_entries), invalidate),
+        ("memoized warm", check(memoized_entries), "pass"),
+    ):
+        elapsed = min(timeit.repeat(func, setup=setup, number=1, repeat=args.repeat))
+        timings[name] = elapsed / checks
+        relative = timings[name] / timings["resolved"] - 1
+        print(f"{name}: {checks} checks in {elapsed * 1000:.2f} ms ({timings[name] * 1e9:.0f} ns/check, {relative:+.0%} vs resolved)")
+
+    # The memo only pays for its cold check once the same instance is checked
+    # for the same (id, field) often enough
+    saved = timings["resolved"] - timings["memoized warm"]
+    if saved > 0:
+        break_even = 1 + (timings["memoized cold"] - timings["resolved"]) / saved
+        print(f"memoization breaks even after {break_even:.1f} checks of the same (id, field) per instance")
+
+
+def wire(args):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    from fastapi.encoders import jsonable_encoder
+    from backend.lib.wire import WS_COMPRESSION_THRESHOLD, Compression, encode
+    from backend.models.database_models import Combatant, Message, Token
+
+    # Events as broadcast, numbered as the pool would number them
+    rng = random.Random(0)
+    token_id = "6a1f3c0e9b2d4e5f6a7b8c9d"
+    events = {
+        "token move": {
+            "type": "update",
+            "changes": {"$set": {f"tokens.{token_id}.x": 1536.25, f"tokens.{token_id}.y": 804.5}},
+        },
+        "stat change": {
+            "type": "update",
+            "changes": {"$set": {"data.stats.hp": 17, "data.stats.armor": 3, "actions": 1}},
+        },
+        "chat message": jsonable_encoder({
+            "type": "send",
+            **Message(
+                id=token_id,
+                sender_id=token_id,
+                character_id=None,
+                speaker="Gorrim Ironjaw",
+                content='<div class="roll"><span class="formula">2d6+3</span> = <span class="result">11</span></div>',
+                timestamp=int(time.time()),
+            ).model_dump(),
+        }),
+        "map tokens": {
+            "type": "update",
+            "changes": {"$set": {"tokens": {
+                f"{i:024x}": Token(
+                    id=f"{i:024x}",
+                    name=f"token {i}",
+                    src="/files/tokens/goblin.webp",
+                    x=rng.uniform(0, 4096),
+                    y=rng.uniform(0, 4096),
+                    z=i,
+                ).model_dump()
+                for i in range(args.tokens)
+            }}},
+        },
+        "combatants": {
+            "type": "order",
+            "order": [],
+            "combatants": [
+                Combatant(id=f"{i:024x}", name=f"combatant {i}", initiative=rng.randint(2, 12)).model_dump()
+                for i in range(args.combatants)
+            ],
+        },
+    }
+    for event in events.values():
+        event.update({"pool": "benchmark", "seq": 1234})
+
+    for name, event in events.items():
+        results = []
+        for encoding in ("json", "msgpack"):
+            frame = encode(event, encoding)
+            size = len(frame.encode() if isinstance(frame, str) else frame)
+            elapsed = min(timeit.repeat(lambda: encode(event, encoding), number=args.number, repeat=5)) / args.number
+            results.append(f"{encoding} {size} B {elapsed * 1e6:.1f} us")
+            # Frames below the compression threshold are sent as they are
+            if size >= WS_COMPRESSION_THRESHOLD:
+                compression = Compression()
+                packed = compression.pack(frame)
+                size = len(packed.encode() if isinstance(packed, str) else packed)
+                elapsed = min(timeit.repeat(lambda: compression.pack(frame), number=args.number, repeat=5)) / args.number
+                results.append(f"{encoding}+deflate {size} B +{elapsed * 1e6:.1f} us")
+        print(f"{name}: {', '.join(results)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    folder_delete_parser = subparsers.add_parser("folder_delete")
+    folder_delete_parser.add_argument("username")
+    folder_delete_parser.add_argument("password")
+    folder_delete_parser.add_argument("--entry-type", default="note", choices=["ability", "character", "note"])
+    folder_delete_parser.add_argument("--folders", type=int, default=1000)
+    folder_delete_parser.add_argument("--fan-out", type=int, default=4)
+    folder_delete_parser.set_defaults(func=folder_delete)
+
+    permissions_parser = subparsers.add_parser("permissions")
+    permissions_parser.add_argument("--entries", type=int, default=500)
+    permissions_parser.add_argument("--users", type=int, default=8)
+    permissions_parser.add_argument("--repeat", type=int, default=20)
+    permissions_parser.set_defaults(func=permissions)
+
+    wire_parser = subparsers.add_parser("wire")
+    wire_parser.add_argument("--tokens", type=int, default=50)
+    wire_parser.add_argument("--combatants", type=int, default=12)
+    wire_parser.add_argument("--number", type=int, default=1000)
+    wire_parser.set_defaults(func=wire)
+
+    args = parser.parse_args()
+    if not hasattr(args, "func"):
+        parser.error("no command selected")
+    args.func(args)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import requests
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from pathlib import Path
+
+
+load_dotenv()
+
+
+HTTP_PORT = os.environ.get("HTTP_PORT", None)
+
+if HTTP_PORT is not None:
+    BASE_URL = f"http://127.0.0.1:{HTTP_PORT}"
+else:
+    BASE_URL = f"http://127.0.0.1"
+
+
+def login(args) -> str:
+    response = requests.post(
+        f"{BASE_URL}/api/login",
+        json={
+            "username": args.username,
+            "password": args.password,
+        }
+    )
+    return response.json()["token"]
+
+
+def api(token: str, endpoint: str, **kwargs) -> dict:
+    response = requests.post(f"{BASE_URL}/api/{endpoint}", json={"token": token, **kwargs}).json()
+    if response["status"] != "success":
+        raise RuntimeError(f"{endpoint}: {response.get('reason')}")
+    return response
+
+
+def permission_filter(args) -> bool:
+    """
+    Check that the mongo filter from Entry.permission_filter() matches
+    exactly the documents Entry.has_permission() allows, on random
+    permission maps.
+    """
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    from backend.lib.enums import Permissions
+    from backend.models.database_models import Entry
+
+    if args.mongo_url:
+        import pymongo
+        client = pymongo.MongoClient(args.mongo_url)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    collection = client[args.database].permission_filter_check
+    collection.drop()
+
+    # A few users and fields, so maps often have entries for the ones checked,
+    # plus one user and one field that never appear in a map
+    rng = random.Random(args.seed)
+    user_ids = [f"user{i}" for i in range(args.users)]
+    fields = ["name", "image", "data"]
+    documents = []
+    for i in range(args.entries):
+        permissions = {}
+        for user_id in ["*"] + user_ids:
+            if rng.random() < 0.6:
+                field_permissions = {}
+                for field in ["*"] + fields:
+                    if rng.random() < 0.5:
+                        field_permissions[field] = int(rng.choice(list(Permissions)))
+                permissions[user_id] = field_permissions
+        documents.append({"_id": i, "permissions": permissions})
+    collection.insert_many([dict(document) for document in documents])
+    entries = {document["_id"]: Entry(permissions=document["permissions"]) for document in documents}
+
+    failures = 0
+    for user_id in ["*", "nobody"] + user_ids:
+        for field in ["*", "text"] + fields:
+            for level in Permissions:
+                found = {document["_id"] for document in collection.find(Entry.permission_filter(user_id, field, level), {"_id": True})}
+                expected = {id for id, entry in entries.items() if entry.has_permission(user_id, field, level)}
+                if found != expected:
+                    failures += 1
+                    wrong = sorted(found ^ expected)[0]
+                    print(f"user {user_id}, field {field}, level {level.name}: {len(found ^ expected)} mismatches, e.g. {documents[wrong]['permissions']}")
+
+    collection.drop()
+    checks = (len(user_ids) + 2) * (len(fields) + 2) * len(Permissions)
+    print(f"permission_filter: {checks - failures}/{checks} filters match has_permission() on {args.entries} entries")
+    return failures == 0
+
+
+def turn_rotation(args) -> bool:
+    """
+    Send end and reverse turn requests for one combat to a running server
+    concurrently, and check that every applied request rotated the order
+    by exactly one and bumped the version once.
+    """
+    token = login(args)
+    combat_id = api(token, "combat/create", name="turn rotation check")["combat"]["id"]
+    try:
+        for i in range(args.combatants):
+            api(token, "combat/add-combatant", combat_id=combat_id, name=f"check {i}")
+        combat = api(token, "combat/get", id=combat_id)["combat"]
+        order = [combatant["id"] for combatant in combat["combatants"]]
+        version = combat["version"]
+
+        def change_turn(i):
+            endpoint = "combat/reverse-turn" if args.reverse and i % 2 else "combat/end-turn"
+            response = requests.post(f"{BASE_URL}/api/{endpoint}", json={"token": token, "id": combat_id}).json()
+            return endpoint, response["status"] == "success"
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as executor:
+            results = list(executor.map(change_turn, range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+        offset = 0
+        for endpoint, success in results:
+            if success:
+                offset += -1 if endpoint == "combat/reverse-turn" else 1
+        applied = sum(success for _, success in results)
+        offset %= len(order)
+        expected = order[offset:] + order[:offset]
+
+        combat = api(token, "combat/get", id=combat_id)["combat"]
+        final = [combatant["id"] for combatant in combat["combatants"]]
+        failures = []
+        if final != expected:
+            failures.append(f"order is {final}, expected {expected}")
+        if combat["version"] != version + applied:
+            failures.append(f"version is {combat['version']}, expected {version + applied}")
+        if applied < args.requests * args.min_applied:
+            failures.append(f"only {applied}/{args.requests} turn changes were applied")
+    finally:
+        api(token, "combat/clear", id=combat_id)
+
+    for failure in failures:
+        print(failure)
+    print(f"turn_rotation: {applied}/{args.requests} concurrent turn changes applied in {elapsed * 1000:.1f} ms, {'consistent' if not failures else 'INCONSISTENT'}")
+    return not failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    permission_filter_parser = subparsers.add_parser("permission_filter")
+    permission_filter_parser.add_argument("--entries", type=int, default=2000)
+    permission_filter_parser.add_argument("--users", type=int, default=3)
+    permission_filter_parser.add_argument("--seed", type=int, default=0)
+    permission_filter_parser.add_argument("--mongo-url", help="check against a real mongod instead of mongomock")
+    permission_filter_parser.add_argument("--database", default="nonsense_check")
+    permission_filter_parser.set_defaults(func=permission_filter)
+
+    turn_rotation_parser = subparsers.add_parser("turn_rotation")
+    turn_rotation_parser.add_argument("username")
+    turn_rotation_parser.add_argument("password")
+    turn_rotation_parser.add_argument("--combatants", type=int, default=7)
+    turn_rotation_parser.add_argument("--requests", type=int, default=200)
+    turn_rotation_parser.add_argument("--threads", type=int, default=16)
+    turn_rotation_parser.add_argument("--reverse", action="store_true")
+    turn_rotation_parser.add_argument("--min-applied", type=float, default=1.0, help="fraction of requests that must succeed")
+    turn_rotation_parser.set_defaults(func=turn_rotation)
+
+    args = parser.parse_args()
+    if not hasattr(args, "func"):
+        parser.error("no command selected")
+    if not args.func(args):
+        sys.exit(1)